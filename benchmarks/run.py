@@ -0,0 +1,163 @@
+'''
+Time and peak memory of the main steps of the mVIP pipeline on a synthetic screen.
+Results are written to JSON with the git commit, to compare runs across commits.
+
+    python benchmarks/run.py --output bench.json
+    python benchmarks/run.py --output new.json --compare bench.json
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import correlations as corr
+import mvip
+from zca import ZCA
+from synthetic import make_screen
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+# Best wall time over `repeat` runs, and the peak of memory allocated by
+# python and numpy (tracemalloc) during the first run
+def measure(name, func, repeat=1):
+    record = {'name': name, 'repeat': repeat}
+    try:
+        tracemalloc.start()
+        start = time.perf_counter()
+        value = func()
+        times = [time.perf_counter() - start]
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        for _ in range(repeat - 1):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        record.update(seconds=min(times), mean_seconds=float(np.mean(times)), peak_mb=peak / 2**20)
+    except Exception as e:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        value = None
+        record['error'] = f'{type(e).__name__}: {e}'
+    status = record.get('error') or f'{record["seconds"]:9.3f} s {record["peak_mb"]:9.1f} MB'
+    print(f'{name:<40} {status}')
+    return record, value
+
+
+def run(args):
+    metadata, features, alleles = make_screen(
+        n_plates=args.plates, wells_per_plate=args.wells_per_plate, n_genes=args.genes,
+        mutants_per_gene=args.mutants_per_gene, replicates=args.replicates,
+        controls_per_plate=args.controls_per_plate, n_features=args.features, seed=args.seed)
+    print(f'{len(metadata)} wells, {len(alleles)} mutants, {features.shape[1]} features')
+    results = []
+
+    def bench(name, func):
+        record, value = measure(name, func, repeat=args.repeat)
+        results.append(record)
+        return value
+
+    ctl_mask = metadata['Metadata_broad_sample_type'] == 'control'
+    controls = features[ctl_mask.to_numpy()]
+    spherer = bench('zca_fit', lambda: ZCA(regularization=1e-2).fit(controls))
+    if spherer is not None:
+        features = bench('zca_transform', lambda: spherer.transform(features))
+
+    corr_matrix = bench('corrcoef', lambda: np.corrcoef(features))
+    treated = metadata[metadata['Metadata_broad_sample_type'] == 'trt']
+    control_table = corr.control_index_table(metadata, 'Metadata_Plate', ctl_mask)
+    bench('allele_to_control_matrix', lambda: corr.allele_to_control_matrix(
+        treated.index, metadata, 'Metadata_Plate', ctl_mask, 20, corr_matrix))
+    bench('allele_to_control_matrix_table', lambda: corr.allele_to_control_matrix(
+        treated.index, metadata, 'Metadata_Plate', ctl_mask, 20, corr_matrix, control_table=control_table))
+    null = bench('null_distribution', lambda: corr.null_distribution(
+        treated.index, corr_matrix, args.replicates, repeats=args.null_repeats))
+
+    def test_alleles(create_images, n_jobs=1):
+        vip = mvip.Morphology_VIP_CNN_Features(metadata, corr_matrix, treatment_samples=args.replicates,
+                                               perturbation_field='x_mutation_status', control_samples=20)
+        with tempfile.TemporaryDirectory() as images_dir:
+            return vip.test_allele_set(alleles, create_images=create_images, null_distribution=null[0:1000],
+                                       images_dir=images_dir, n_jobs=n_jobs, seed=args.seed)
+
+    if null is not None:
+        tested = bench('test_allele_set', lambda: test_alleles(False))
+        if args.n_jobs != 1:
+            bench(f'test_allele_set_jobs{args.n_jobs}', lambda: test_alleles(False, args.n_jobs))
+        if args.images:
+            bench('test_allele_set_images', lambda: test_alleles(True))
+        if tested is not None:
+            vip = mvip.Morphology_VIP_CNN_Features(metadata, corr_matrix, treatment_samples=args.replicates,
+                                                   perturbation_field='x_mutation_status', control_samples=20)
+            bench('adjust_pvalues', lambda: vip.adjust_pvalues(tested.copy(), Q=0.05))
+    return results
+
+
+# Print the time and memory ratios of every benchmark against a previous run
+def compare(results, baseline):
+    previous = {r['name']: r for r in baseline['results']}
+    print(f'\nCompared to {baseline.get("commit")}')
+    for r in results:
+        old = previous.get(r['name'])
+        if old is None or 'seconds' not in old or 'seconds' not in r:
+            continue
+        print(f'{r["name"]:<40} time x{r["seconds"] / old["seconds"]:6.2f}   '
+              f'memory x{r["peak_mb"] / max(old["peak_mb"], 1e-9):6.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the mVIP pipeline on a synthetic screen')
+    parser.add_argument('--plates', type=int, default=4)
+    parser.add_argument('--wells-per-plate', type=int, default=384)
+    parser.add_argument('--genes', type=int, default=20)
+    parser.add_argument('--mutants-per-gene', type=int, default=3)
+    parser.add_argument('--replicates', type=int, default=8)
+    parser.add_argument('--controls-per-plate', type=int, default=32)
+    parser.add_argument('--features', type=int, default=256)
+    parser.add_argument('--null-repeats', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every benchmark, the best time is kept')
+    parser.add_argument('--n-jobs', type=int, default=1, help='also run test_allele_set with this many workers')
+    parser.add_argument('--images', action='store_true', help='also run test_allele_set with create_images')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='JSON output of a previous run')
+    args = parser.parse_args()
+
+    commit, dirty = git_commit()
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.platform(),
+        'cpus': os.cpu_count(),
+        'params': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'results': run(args),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report['results'], json.load(f))
@@ -0,0 +1,59 @@
+'''
+Synthetic Cell Painting screens for benchmarks
+'''
+import numpy as np
+import pandas as pd
+
+ROWS = 'ABCDEFGHIJKLMNOP'
+
+
+def well_names(wells_per_plate):
+    cols = 24 if wells_per_plate > 96 else 12
+    return [f'{ROWS[i // cols]}{i % cols + 1:02d}' for i in range(wells_per_plate)]
+
+
+# Metadata and well profiles of a screen with n_genes genes, each with a
+# closed wild type (<gene>_WT.c) and mutants_per_gene mutants. Every allele
+# has `replicates` wells spread over the plates, and every plate has
+# controls_per_plate EMPTY wells. Profiles are a per-allele signal plus a
+# plate effect and noise.
+# The metadata has the columns used by Morphology_VIP in notebook 2 and a
+# 0..n-1 index, so its index matches the rows of the correlation matrix.
+def make_screen(n_plates=4, wells_per_plate=384, n_genes=20, mutants_per_gene=3, replicates=8,
+                controls_per_plate=32, n_features=256, signal=0.5, seed=0):
+    rng = np.random.default_rng(seed)
+    alleles = []
+    for g in range(n_genes):
+        alleles.append(f'G{g}_WT.c')
+        alleles += [f'G{g}_p.X{m}' for m in range(mutants_per_gene)]
+
+    plates = [str(52600 + p) for p in range(n_plates)]
+    treatments = np.repeat(alleles, replicates)
+    # Replicates of an allele go to consecutive plates
+    plate_of = np.arange(len(treatments)) % n_plates
+    rows = []
+    for p, plate in enumerate(plates):
+        samples = ['EMPTY'] * controls_per_plate + list(treatments[plate_of == p])
+        if len(samples) > wells_per_plate:
+            raise ValueError(f'{len(samples)} samples do not fit in {wells_per_plate} wells per plate')
+        wells = well_names(wells_per_plate)
+        for well, sample in zip(rng.permutation(wells), samples):
+            rows.append((plate, well, sample))
+
+    metadata = pd.DataFrame(rows, columns=['Metadata_Plate', 'Metadata_Well', 'x_mutation_status'])
+    metadata = metadata.sort_values(by=['Metadata_Plate', 'Metadata_Well']).reset_index(drop=True)
+    is_control = metadata['x_mutation_status'] == 'EMPTY'
+    metadata['pert_type'] = np.where(is_control, 'EMPTY', 'trt_oe')
+    metadata['Metadata_broad_sample_type'] = np.where(is_control, 'control', 'trt')
+    metadata['Metadata_broad_sample'] = metadata['x_mutation_status']
+
+    names = ['EMPTY'] + alleles
+    effects = signal * rng.standard_normal((len(names), n_features))
+    effects[0] = 0
+    plate_effects = 0.2 * rng.standard_normal((n_plates, n_features))
+    codes = pd.Categorical(metadata['x_mutation_status'], categories=names).codes
+    plate_codes = pd.Categorical(metadata['Metadata_Plate'], categories=plates).codes
+    features = effects[codes] + plate_effects[plate_codes] + rng.standard_normal((len(metadata), n_features))
+
+    mutants = [a for a in alleles if '_WT' not in a]
+    return metadata, features, mutants
@@ -0,0 +1,216 @@
+import collections
+import json
+import numpy as np
+import pandas as pd
+
+# Correlation matrices that can be used in place of the dense np.corrcoef
+# array in correlations.py and mvip.py. They support the 2-D integer
+# indexing used there (cmatrix[rows, cols] with broadcastable index arrays,
+# slices or scalars) and compute or read only the requested entries.
+# PackedCorrelationMatrix stores a precomputed matrix on disk as its upper
+# triangle (n (n + 1) / 2 values), memory mapped on load.
+
+
+# Convert a 2-D indexing key into a pair of broadcastable integer arrays
+def broadcast_key(key, n):
+    if not isinstance(key, tuple) or len(key) != 2:
+        raise IndexError("Correlation matrices only support 2-D indexing")
+    rows, cols = [np.arange(n)[k] if isinstance(k, slice) else np.asarray(k) for k in key]
+    if rows.dtype == bool or cols.dtype == bool:
+        raise IndexError("Boolean masks are not supported, use integer indices")
+    # A slice next to an index array selects the outer product, like numpy
+    if rows.ndim >= 1 and cols.ndim >= 1 and (isinstance(key[0], slice) or isinstance(key[1], slice)):
+        rows = rows.reshape(rows.shape + (1,) * cols.ndim)
+    rows, cols = np.broadcast_arrays(rows, cols)
+    rows = np.where(rows < 0, rows + n, rows)
+    cols = np.where(cols < 0, cols + n, cols)
+    return rows, cols
+
+
+# Pearson correlations computed on demand from the well profiles.
+# Profiles are centered and scaled to unit norm once, so every correlation
+# is a float32 dot product. Memory scales with wells x features instead of
+# wells^2. Requested blocks are cached in an LRU keyed by their row and
+# column index sets.
+class LazyCorrelationMatrix(object):
+
+    def __init__(self, profiles, dtype=np.float32, cache_size=64, chunk_elements=2**24):
+        X = np.array(profiles, dtype=dtype)
+        X -= X.mean(axis=1, keepdims=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            X /= np.linalg.norm(X, axis=1, keepdims=True)
+        self.profiles = X
+        self.shape = (X.shape[0], X.shape[0])
+        self.dtype = X.dtype
+        self.cache_size = cache_size
+        # Bound on (entries x features) computed at once for scattered entries
+        self.chunk_elements = chunk_elements
+        self._cache = collections.OrderedDict()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getstate__(self):
+        # The block cache is not sent to worker processes
+        state = self.__dict__.copy()
+        state["_cache"] = collections.OrderedDict()
+        return state
+
+    def __getitem__(self, key):
+        rows, cols = broadcast_key(key, self.shape[0])
+        unique_rows, row_pos = np.unique(rows, return_inverse=True)
+        unique_cols, col_pos = np.unique(cols, return_inverse=True)
+        if rows.size >= len(unique_rows) * len(unique_cols):
+            block = self.block(unique_rows, unique_cols)
+            return block[row_pos.reshape(rows.shape), col_pos.reshape(cols.shape)]
+        # Scattered entries (e.g. upper triangles of many groups): compute
+        # only the requested pairs instead of the dense block around them
+        return self.pairs(rows.ravel(), cols.ravel()).reshape(rows.shape)
+
+    # Correlation block between two sets of wells
+    def block(self, rows, cols):
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        key = (rows.tobytes(), cols.tobytes())
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        block = np.dot(self.profiles[rows], self.profiles[cols].T)
+        np.clip(block, -1, 1, out=block)
+        if self.cache_size > 0:
+            self._cache[key] = block
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return block
+
+    # Correlation of each (rows[i], cols[i]) pair
+    def pairs(self, rows, cols):
+        values = np.empty(len(rows), dtype=self.dtype)
+        step = max(1, self.chunk_elements // max(1, self.profiles.shape[1]))
+        for start in range(0, len(rows), step):
+            a = self.profiles[rows[start:start + step]]
+            b = self.profiles[cols[start:start + step]]
+            values[start:start + step] = np.einsum("ij,ij->i", a, b)
+        np.clip(values, -1, 1, out=values)
+        return values
+
+    # Write the full matrix to an .npy file in blocks of rows and return
+    # it as a read-only memmap
+    def save_memmap(self, path, block_size=4096):
+        n = self.shape[0]
+        out = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=self.shape)
+        for start in range(0, n, block_size):
+            stop = min(start + block_size, n)
+            block = np.dot(self.profiles[start:stop], self.profiles.T)
+            np.clip(block, -1, 1, out=block)
+            out[start:stop] = block
+        out.flush()
+        del out
+        return np.load(path, mmap_mode="r")
+
+
+# Position of entry (i, j) in the packed upper triangle (diagonal included)
+# of an n x n matrix, stored row by row
+def packed_position(rows, cols, n):
+    lo = np.minimum(rows, cols).astype(np.int64)
+    hi = np.maximum(rows, cols).astype(np.int64)
+    return lo * n - lo * (lo - 1) // 2 + (hi - lo)
+
+
+# Write the upper triangle of a symmetric matrix (dense array, memmap or
+# DataFrame) to <path>.bin with a <path>.json sidecar, in blocks of rows.
+# labels are the names of the rows (e.g. the index of the profiles frame).
+def write_packed(matrix, path, dtype=np.float32, labels=None, block_size=1024):
+    n = matrix.shape[0]
+    if matrix.shape != (n, n):
+        raise ValueError(f"Expected a square matrix, got shape {matrix.shape}")
+    with open(path + ".bin", "wb") as out:
+        for start in range(0, n, block_size):
+            stop = min(start + block_size, n)
+            block = np.asarray(matrix[start:stop] if not hasattr(matrix, "iloc") else matrix.iloc[start:stop],
+                               dtype=dtype)
+            out.write(np.concatenate([block[i - start, i:] for i in range(start, stop)]).tobytes())
+    info = {"shape": [n, n], "dtype": np.dtype(dtype).name, "layout": "upper"}
+    if labels is not None:
+        info["labels"] = np.asarray(labels).tolist()
+    with open(path + ".json", "w") as f:
+        json.dump(info, f)
+    return PackedCorrelationMatrix(path)
+
+
+# Convert a profiles parquet file that stores the correlation matrix as one
+# column per row label (l1000.parquet of notebook 1) into a packed matrix at
+# matrix_path and, if metadata_path is given, a parquet file with the other
+# columns only. The rows of the packed matrix follow the index of the file.
+def convert_matrix_columns(parquet_path, matrix_path, metadata_path=None, dtype=np.float32, block_size=1024):
+    frame = pd.read_parquet(parquet_path)
+    matrix_cols = list(frame.index)
+    if metadata_path is not None:
+        frame[[c for c in frame.columns if c not in set(matrix_cols)]].to_parquet(metadata_path)
+    return write_packed(frame[matrix_cols], matrix_path, dtype=dtype, labels=frame.index, block_size=block_size)
+
+
+# Symmetric correlation matrix stored as its packed upper triangle in a
+# float32 or float16 binary file, memory mapped on load. Indexing returns
+# float32 values and only reads the requested entries. take(rows) returns
+# the matrix of a subset of rows, renumbered 0..len(rows)-1, without copying
+# the file (e.g. after filtering and resetting the index of the metadata).
+class PackedCorrelationMatrix(object):
+
+    def __init__(self, path, index=None):
+        self.path = path
+        with open(path + ".json") as f:
+            self.info = json.load(f)
+        self.size = self.info["shape"][0]
+        self.index = None if index is None else np.asarray(index, dtype=np.int64)
+        n = self.size if self.index is None else len(self.index)
+        self.shape = (n, n)
+        self.dtype = np.dtype(np.float32)
+        self._open()
+
+    def _open(self):
+        count = self.size * (self.size + 1) // 2
+        if count > 0:
+            self.values = np.memmap(self.path + ".bin", dtype=self.info["dtype"], mode="r", shape=(count,))
+        else:
+            self.values = np.zeros(0, dtype=self.info["dtype"])
+
+    def __getstate__(self):
+        # Worker processes map the file again instead of receiving a copy
+        state = self.__dict__.copy()
+        del state["values"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return self.shape[0]
+
+    # Names of the rows, from the sidecar
+    @property
+    def labels(self):
+        labels = self.info.get("labels")
+        if labels is None or self.index is None:
+            return labels
+        return [labels[i] for i in self.index]
+
+    def __getitem__(self, key):
+        rows, cols = broadcast_key(key, self.shape[0])
+        if self.index is not None:
+            rows, cols = self.index[rows], self.index[cols]
+        values = self.values[packed_position(rows.ravel(), cols.ravel(), self.size)]
+        return values.astype(self.dtype, copy=False).reshape(rows.shape)
+
+    # Matrix of the given rows (positions in this matrix)
+    def take(self, rows):
+        rows = np.asarray(rows)
+        rows = np.flatnonzero(rows) if rows.dtype == bool else rows.astype(np.int64)
+        if self.index is not None:
+            rows = self.index[rows]
+        return PackedCorrelationMatrix(self.path, index=rows)
+
+    # Dense array, only for small matrices or subsets
+    def to_array(self):
+        return self[:, :]
@@ -38,34 +38,94 @@ def correlation_matrix(sample, first_feature):
 # Takes as input the row indices
 # Returns the list of values in the upper triangle
 def sample_upper_triangle(sample_rows, cmatrix):
-    sub_matrix = cmatrix[sample_rows, sample_rows]
-    values = []
-    for i in range(len(sample_rows)):
-        for j in range(i+1, len(sample_rows)):
-            row = sample_rows[i]
-            col = sample_rows[j]
-            values.append(cmatrix[row, col])
-    return values
+    sample_rows = np.asarray(sample_rows)
+    rows, cols = np.triu_indices(len(sample_rows), 1)
+    return list(cmatrix[sample_rows[rows], sample_rows[cols]])
 
 # Extract a non-symmetric submatrix from the correlation matrix
 # Assumes sample1 and sample 2 are disjoint sets of replicates
+# The block is read with a single indexing operation, so cmatrix can also
+# be one of the matrices in correlation_store.
 def sample_rectangular_matrix(sample1, sample2, cmatrix):
-    sub_matrix = cmatrix[sample1, :]
-    sub_matrix = sub_matrix[:, sample2]
-    return sub_matrix
+    sample1 = np.asarray(sample1)
+    sample2 = np.asarray(sample2)
+    return cmatrix[sample1[:, np.newaxis], sample2[np.newaxis, :]]
 
 
 # Compute the mean row of a self-correlation matrix, ignoring the
 # diagonal values (assuming these are the maximum values)
+# Also accepts a stack of matrices (... x n x n) and returns one row per matrix
 def correlation_median_row(cmatrix):
-    X = np.sort(cmatrix, axis=0)
-    median_idx = int( (X.shape[0]-1)/2 )
-    return X[median_idx,:]
+    X = np.sort(cmatrix, axis=-2)
+    median_idx = int( (X.shape[-2]-1)/2 )
+    return X[..., median_idx, :]
+
+
+# Index the control wells of every plate once, so that sampling controls for
+# an allele does not need to filter the metadata again.
+# Returns a dict plate -> array of control indices and the array of all
+# controls, which is used when a plate does not have enough of them.
+def control_index_table(metadata, plate_field, ctl_mask):
+    controls = metadata[ctl_mask]
+    all_controls = np.asarray(controls.index)
+    plates = controls.groupby(plate_field, sort=False).indices
+    table = {plate: all_controls[pos] for plate, pos in plates.items()}
+    return table, all_controls
+
+
+# Sample control_samples controls for each replicate, given their plates, using a
+# table built with control_index_table. Returns a (replicates x control_samples)
+# array of indices into the correlation matrix.
+# With rng=None the python random module is used and the draws are the same
+# as in the original per-replicate implementation. A numpy Generator can be
+# passed instead to sample all replicates of a plate in one step.
+def sample_control_index(plates, control_table, control_samples, rng=None):
+    table, all_controls = control_table
+    empty = all_controls[:0]
+    if rng is None:
+        ctl_idx = []
+        for plate in plates:
+            ctl = table.get(plate, empty)
+            if len(ctl) > control_samples:
+                ctl = list(ctl)
+                random.shuffle(ctl)
+                ctl = ctl[0:control_samples]
+            elif len(ctl) < control_samples:
+                ctl = list(all_controls)
+                random.shuffle(ctl)
+                ctl = ctl[0:control_samples]
+            ctl_idx.append(ctl)
+        return np.asarray(ctl_idx, dtype=all_controls.dtype).reshape(len(plates), -1)
+
+    groups = {}
+    for row, plate in enumerate(plates):
+        groups.setdefault(plate, []).append(row)
+    width = min(control_samples, len(all_controls))
+    ctl_idx = np.empty((len(plates), width), dtype=all_controls.dtype)
+    for plate, rows in groups.items():
+        ctl = table.get(plate, empty)
+        if len(ctl) < control_samples:
+            ctl = all_controls
+        if len(ctl) == width:
+            ctl_idx[rows] = ctl
+        else:
+            order = np.argsort(rng.random((len(rows), len(ctl))), axis=1)
+            ctl_idx[rows] = ctl[order[:, 0:width]]
+    return ctl_idx
 
 
 # Extract asymmetric matrix of alleles vs controls
 # This heavily depends on metadata. For each allele, we want control that are in the same plate
-def allele_to_control_matrix(allele_index, metadata, plate_field, ctl_mask, control_samples, corr_matrix):
+# If control_table (see control_index_table) is given, the controls are looked
+# up in the table and the matrix is gathered in a single indexing operation.
+def allele_to_control_matrix(allele_index, metadata, plate_field, ctl_mask, control_samples, corr_matrix,
+                             control_table=None, rng=None):
+    if control_table is not None:
+        allele_index = np.asarray(allele_index)
+        plates = metadata.loc[allele_index, plate_field].to_numpy()
+        ctl_idx = sample_control_index(plates, control_table, control_samples, rng=rng)
+        return corr_matrix[allele_index[:, np.newaxis], ctl_idx]
+
     control_corr_matrix = []
     for i in allele_index:
         a = metadata.loc[i]
@@ -94,16 +154,34 @@ def allele_to_control_matrix(allele_index, metadata, plate_field, ctl_mask, cont
 # Creates groups of size "sample_size" from some rows in the
 # correlation matrix "cmatrix". The process is repeated several times
 # to create a large enough background distribution
+# All permutations of a chunk of repeats are drawn as one integer array and
+# their group medians are computed in one step. A repeat gathers about
+# len(sample_rows) x (sample_size - 1) / 2 correlations, plus their indices
+# and the permutation, so by default the number of repeats per chunk is
+# chosen to keep about max_elements (8-byte) values per chunk, whatever the
+# number of rows and the sample size. chunk_size sets it explicitly. The
+# result does not depend on the chunks.
+# rng is an optional numpy Generator, by default the np.random state is used.
 # TODO: choose random groups of samples that do not share the same treatment
-def null_distribution(sample_rows, cmatrix, sample_size, repeats=30):
-    distribution = []
-    for i in tqdm(range(repeats)):
-        index = np.asarray([ k for k in sample_rows])
-        np.random.shuffle(index)
-        for j in range(0, len(index), sample_size):
-            median_corr = median_correlation(index[j:j+sample_size], cmatrix)
-            distribution.append(median_corr)
-    return distribution
+def null_distribution(sample_rows, cmatrix, sample_size, repeats=30, chunk_size=None, rng=None,
+                      max_elements=2**24):
+    index = np.asarray([ k for k in sample_rows])
+    draw = rng.random if rng is not None else np.random.random_sample
+    full = (len(index) // sample_size) * sample_size
+    groups = len(index) // sample_size + int(full < len(index))
+    if chunk_size is None:
+        per_repeat = len(index) * (3 * max(sample_size - 1, 1) // 2 + 2)
+        chunk_size = max(1, max_elements // max(per_repeat, 1))
+    distribution = np.empty((repeats, groups))
+    for start in tqdm(range(0, repeats, chunk_size)):
+        stop = min(start + chunk_size, repeats)
+        perms = index[np.argsort(draw((stop - start, len(index))), axis=1)]
+        blocks = perms[:, 0:full].reshape(stop - start, -1, sample_size)
+        distribution[start:stop, 0:blocks.shape[1]] = batch_median_correlation(blocks, cmatrix)
+        if full < len(index):
+            # The last group is smaller when sample_size does not divide the rows
+            distribution[start:stop, -1] = batch_median_correlation(perms[:, full:], cmatrix)
+    return distribution.ravel().tolist()
 
 # For one particular treatment compute the median of replicates, 
 # and also create a null distribution for comparison.
@@ -113,26 +191,39 @@ def median_correlation(sample_index, cmatrix):
     median = np.median(corr_values)
     return median
 
+# Same as median_correlation for many groups at once. groups is a
+# (... x k) array of row indices, the result has one median per group.
+def batch_median_correlation(groups, cmatrix):
+    groups = np.asarray(groups)
+    rows, cols = np.triu_indices(groups.shape[-1], 1)
+    values = cmatrix[groups[..., rows], groups[..., cols]]
+    return np.median(values, axis=-1)
+
 # Compute replicate correlation for all treatments, and report
 # the fraction of treatments whose replicate correlation is greater than
 # the 95th percentile of the null.
-def fraction_strong_test(treated_samples, treatments, corr_matrix, null, treatment_field, sample_size):
+# Replicates are sampled from a single groupby of the treatments, and the
+# medians of all treatments are computed together.
+def fraction_strong_test(treated_samples, treatments, corr_matrix, null, treatment_field, sample_size, rng=None):
     null.sort()
     p95 = null[ int( 0.95*len(null) ) ]
-    results = {}
+    draw = rng.random if rng is not None else np.random.random_sample
+    index = np.asarray(treated_samples.index)
+    groups = treated_samples.groupby(treatment_field).indices
+    tested, samples = [], []
     for t in tqdm(treatments):
-        sample = treated_samples[treated_samples[treatment_field] == t]
-        replicates = len(sample)
-        if replicates >= sample_size:
-            sample_data = sample.sample(sample_size)
-            median = median_correlation(sample_data.index, corr_matrix)
-            results[t] = median
-            #replicates -= sample_size
+        rows = groups.get(t, [])
+        if len(rows) >= sample_size:
+            choice = np.argsort(draw(len(rows)))[0:sample_size]
+            tested.append(t)
+            samples.append(index[rows[choice]])
+    samples = np.asarray(samples, dtype=index.dtype).reshape(-1, sample_size)
+    medians = batch_median_correlation(samples, corr_matrix)
+    results = dict(zip(tested, medians))
     # Evaluate results:
-    fraction = np.sum([m > p95 for m in results.values()])/len(results)
+    fraction = np.sum(medians > p95)/len(results)
     print("Treatments tested:", len(results))
     print("At 95th percentile of the null")
     print("Fraction strong: {:5.2f}%".format(fraction*100))
     print("Null threshold: {:6.4f}".format(p95))
     return results
-
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import numpy as np
+import scipy.sparse
+from concurrent.futures import ThreadPoolExecutor
+
+# Single-cell UMAP embeddings for notebook 4. Instead of one UMAP fit per
+# wild type on the controls plus the cells of that gene, a SharedEmbedding
+# is fit once on a sample of normalized control cells (optionally with a
+# stratified sample of all alleles), saved with its kNN graph, and the cells
+# of every allele are projected with UMAP.transform. Projections are cached
+# on disk, keyed by allele and by the fingerprints of the normalizer and of
+# the fitted model. The output directory contains:
+#  - model.pkl: the fitted umap.UMAP object
+#  - graph.npz: fuzzy simplicial set of the fit sample (scipy.sparse)
+#  - knn.npz: kNN indices and distances of the fit sample, if UMAP built them
+#  - embedding.json: parameters and fingerprints, written when the fit is saved
+#  - cache/<key>/<allele>.npy: projected cells of every allele
+
+
+# Hash of the fitted state of a normalizer: its own fingerprint (normalizers
+# of zca.py), or the arrays and numbers in its attributes (mean and whitening
+# matrix of SCWhiteningNormalizer, MEAN and STD of AllControlsNormalizer in
+# notebook 4)
+def normalizer_fingerprint(normalizer):
+    if normalizer is None:
+        return 'none'
+    if hasattr(normalizer, 'fingerprint'):
+        return normalizer.fingerprint()
+    digest = hashlib.sha1(type(normalizer).__name__.encode())
+    for name, value in sorted(vars(normalizer).items()):
+        if isinstance(value, np.ndarray):
+            digest.update(name.encode())
+            digest.update(str(value.dtype).encode() + str(value.shape).encode())
+            digest.update(np.ascontiguousarray(value).tobytes())
+        elif isinstance(value, (bool, int, float, str, np.number)):
+            digest.update(f'{name}={value!r}'.encode())
+    return digest.hexdigest()
+
+
+# Apply a normalizer with the interface of notebook 4 (normalize(X, images))
+# or a fitted transformer such as ZCA (transform(X))
+def apply_normalizer(normalizer, features, images=None):
+    if normalizer is None:
+        return features
+    if hasattr(normalizer, 'normalize'):
+        return normalizer.normalize(features, images)
+    return normalizer.transform(features)
+
+
+# Up to `size` random rows of every allele of a SingleCellStore (all alleles
+# by default), sorted, to add to the control sample of the fit
+def stratified_rows(store, size, alleles=None, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for allele in (store.alleles if alleles is None else alleles):
+        start, stop = store.ranges[allele]
+        n = min(size, stop - start)
+        rows.append(start + np.sort(rng.choice(stop - start, n, replace=False)))
+    return np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+
+
+# File name of an allele in the cache. Names such as 'NA@EMPTY' or
+# 'KRAS@KRAS_p.G12V' are kept readable, with a short hash against collisions.
+def allele_filename(allele):
+    slug = re.sub(r'[^\w.@-]+', '_', allele)
+    return f'{slug}-{hashlib.sha1(allele.encode()).hexdigest()[0:8]}.npy'
+
+
+class SharedEmbedding(object):
+
+    # umap_options are passed to umap.UMAP (e.g. random_state for
+    # reproducible fits). Projections run in batches of batch_size cells on
+    # n_jobs threads.
+    def __init__(self, output_dir, normalizer=None, n_neighbors=15, batch_size=4096, n_jobs=None,
+                 **umap_options):
+        self.output_dir = output_dir
+        self.normalizer = normalizer
+        self.n_neighbors = n_neighbors
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs or os.cpu_count() or 1
+        self.umap_options = umap_options
+        self.model = None
+        self.model_fingerprint = None
+        self.normalizer_fingerprint = normalizer_fingerprint(normalizer)
+
+    # Fit UMAP on a sample of cells (e.g. the control sample of notebook 4),
+    # normalized with the normalizer, and save the model
+    def fit(self, features, images=None):
+        import umap
+        features = np.asarray(apply_normalizer(self.normalizer, features, images), dtype=np.float32)
+        self.model = umap.UMAP(n_neighbors=self.n_neighbors, **self.umap_options).fit(features)
+        digest = hashlib.sha1(features.tobytes())
+        digest.update(json.dumps([self.n_neighbors, sorted(self.umap_options.items())], default=str).encode())
+        # Without random_state, a refit on the same sample gives another
+        # embedding, whose projections must not be read from the cache of the
+        # previous fit
+        digest.update(np.ascontiguousarray(self.model.embedding_).tobytes())
+        self.model_fingerprint = digest.hexdigest()
+        self.save()
+        return self
+
+    # Fit on the control cells of a SingleCellStore, sampled to max_points
+    # cells, plus up to per_allele cells of every allele
+    def fit_store(self, store, control_allele, max_points=15000, per_allele=0, seed=0):
+        rng = np.random.default_rng(seed)
+        start, stop = store.ranges[control_allele]
+        rows = start + np.sort(rng.choice(stop - start, min(max_points, stop - start), replace=False))
+        if per_allele > 0:
+            others = [a for a in store.alleles if a != control_allele]
+            rows = np.concatenate([rows, stratified_rows(store, per_allele, others, seed=seed)])
+        self.fit_rows = rows
+        return self.fit(store.features[rows], store.image_names(rows))
+
+    @property
+    def embedding_(self):
+        return self.model.embedding_
+
+    def save(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, 'model.pkl'), 'wb') as f:
+            pickle.dump(self.model, f, protocol=pickle.HIGHEST_PROTOCOL)
+        scipy.sparse.save_npz(os.path.join(self.output_dir, 'graph.npz'), self.model.graph_.tocsr())
+        # UMAP does not keep a kNN graph for small samples (< 4096 cells),
+        # where it computes all pairwise distances instead
+        if getattr(self.model, '_knn_indices', None) is not None:
+            np.savez(os.path.join(self.output_dir, 'knn.npz'), indices=self.model._knn_indices,
+                     distances=self.model._knn_dists)
+        with open(os.path.join(self.output_dir, 'embedding.json'), 'w') as f:
+            json.dump({'n_neighbors': self.n_neighbors, 'umap_options': self.umap_options,
+                       'model_fingerprint': self.model_fingerprint,
+                       'normalizer_fingerprint': self.normalizer_fingerprint,
+                       'n_samples': int(self.model.embedding_.shape[0])}, f, indent=2, default=str)
+
+    # Load a saved embedding. The normalizer is not saved with the model and
+    # has to be given again; its fingerprint must match the one of the fit.
+    @classmethod
+    def load(cls, output_dir, normalizer=None, batch_size=4096, n_jobs=None):
+        with open(os.path.join(output_dir, 'embedding.json')) as f:
+            info = json.load(f)
+        embedding = cls(output_dir, normalizer, n_neighbors=info['n_neighbors'], batch_size=batch_size,
+                        n_jobs=n_jobs, **info['umap_options'])
+        if embedding.normalizer_fingerprint != info['normalizer_fingerprint']:
+            raise ValueError(f'The normalizer does not match the one used to fit {output_dir}')
+        with open(os.path.join(output_dir, 'model.pkl'), 'rb') as f:
+            embedding.model = pickle.load(f)
+        embedding.model_fingerprint = info['model_fingerprint']
+        return embedding
+
+    # Project normalized features in batches on a pool of threads
+    def transform(self, features):
+        features = np.asarray(features, dtype=np.float32)
+        if features.shape[0] == 0:
+            return np.zeros((0, self.model.n_components), dtype=np.float32)
+        batches = [features[i:i + self.batch_size] for i in range(0, features.shape[0], self.batch_size)]
+        # The first batch also builds the search index of the model, which
+        # is shared by the other batches
+        first = self.model.transform(batches[0])
+        if len(batches) == 1:
+            return first
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as pool:
+            rest = list(pool.map(self.model.transform, batches[1:]))
+        return np.concatenate([first] + rest)
+
+    def cache_dir(self):
+        key = hashlib.sha1((self.model_fingerprint + self.normalizer_fingerprint).encode()).hexdigest()
+        return os.path.join(self.output_dir, 'cache', key[0:16])
+
+    # Projection of all the cells of an allele of a SingleCellStore, in the
+    # order of the store, and their image names. Computed once per allele,
+    # model and normalizer.
+    def embed(self, store, allele):
+        rows = np.arange(*store.ranges[allele])
+        images = store.image_names(rows)
+        path = os.path.join(self.cache_dir(), allele_filename(allele))
+        if os.path.exists(path):
+            return np.load(path), images
+        features = apply_normalizer(self.normalizer, store.get(allele), images)
+        Y = self.transform(features)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temporary file first, so that an interrupted run does
+        # not leave a partial projection in the cache
+        tmp = path + '.tmp.npy'
+        np.save(tmp, Y)
+        os.replace(tmp, path)
+        return Y, images
+
+    def embed_alleles(self, store, alleles):
+        return {allele: self.embed(store, allele) for allele in alleles}
@@ -0,0 +1,147 @@
+import os
+import threading
+import numpy
+import pandas
+from concurrent.futures import ThreadPoolExecutor
+import plotly.io as pio
+from plotly import graph_objects as go
+from plotly.subplots import make_subplots
+from plotly import express as px
+import correlations as corr
+
+# Figures of Morphology_VIP. Evaluation only keeps the small arrays needed
+# for the plots (plot_data); rendering to PNG and JSON is done by
+# write_figures, synchronously or in the background with a FigureWriter.
+
+CMAP_TYPE = {'EMPTY': '#1f77b4', 'REF':'#2CA02C',
+             'VAR': '#FF7F0E', 'VAR_REF': '#8C564B'}
+
+HEATMAP_SAMPLES = ["REF_REF", "VAR_REF", "VAR_VAR"]
+
+
+# Evenly spaced rows and columns of a matrix, at most max_size of each
+def downsample(matrix, max_size=None):
+    matrix = numpy.asarray(matrix)
+    if max_size is None:
+        return matrix
+    rows = numpy.unique(numpy.linspace(0, matrix.shape[0] - 1, min(max_size, matrix.shape[0])).astype(int))
+    cols = numpy.unique(numpy.linspace(0, matrix.shape[1] - 1, min(max_size, matrix.shape[1])).astype(int))
+    return matrix[numpy.ix_(rows, cols)]
+
+
+# Arrays plotted for one allele: median correlations of the dot plot and
+# the three heatmaps, downsampled to max_size x max_size
+def plot_data(results, matrices, max_size=None):
+    row = numpy.median(matrices["wt_mut"], axis=0)
+    col = numpy.median(matrices["wt_mut"], axis=1)
+    return {
+        "mutant": results["mutant"],
+        "dots": {
+            # "REF_CTL": numpy.median(matrices["wt_ctl"], axis=1),
+            "REF": corr.correlation_median_row(matrices["wt_wt"]),
+            "VAR_REF": numpy.concatenate([row, col]),
+            "VAR": corr.correlation_median_row(matrices["mut_mut"]),
+            # "VAR_CTL": numpy.median(matrices["mut_ctl"], axis=1),
+        },
+        "heatmaps": [downsample(matrices[k], max_size) for k in ["wt_wt", "wt_mut", "mut_mut"]],
+    }
+
+
+def dots_figure(data):
+    samples = [s for s, values in data["dots"].items() for _ in values]
+    values = numpy.concatenate([numpy.asarray(v, dtype=float).ravel() for v in data["dots"].values()])
+    dots = pandas.DataFrame({"Sample": samples, "Correlation": values})
+    fig = px.box(dots, x='Sample', y='Correlation', color='Sample',
+                 points='all', color_discrete_map=CMAP_TYPE)
+    fig.update_layout(showlegend=False,
+                      yaxis_range=(-0.2, 1.0),
+                      # margin=dict(l=0, r=0, t=0, b=0)
+                      )
+    return fig
+
+
+def matrices_figure(data):
+    # zmin, zmax = min(map(numpy.min, heatmaps)), max(map(numpy.max, heatmaps))
+    # zmin, zmax = dots.Correlation.min(), dots.Correlation.max()
+    zmin, zmax = -0.2, 1.0
+    zranges = {'zmin': zmin, 'zmax': zmax}
+    fig = make_subplots(rows=1, cols=3, horizontal_spacing=0.05, subplot_titles=HEATMAP_SAMPLES)
+    for i, matrix in enumerate(data["heatmaps"], 1):
+        scaled_matrix = (numpy.clip(matrix, zmin, zmax) - zmin) / (zmax - zmin)
+        hmap = go.Heatmap(z=scaled_matrix,
+                          colorscale=[(0, "blue"), (0.5, "white"), (1, "red")],
+                          **zranges)
+        fig.add_trace(hmap, row=1, col=i)
+    fig.update_traces(showscale=False)
+    fig.update_xaxes(showticklabels=False)
+    fig.update_yaxes(showticklabels=False, autorange='reversed')
+    fig.update_layout(#margin=dict(l=0, r=0, t=30, b=0),
+                      height=340
+                      )
+    return fig
+
+
+# Figures of one allele with their output names, without extension
+def allele_figures(data, images_dir):
+    base = os.path.join(images_dir, data["mutant"])
+    return [(dots_figure(data), base + "_dots"), (matrices_figure(data), base + "_matrices")]
+
+
+# Write <mutant>_dots and <mutant>_matrices as PNG (if png) and JSON of a
+# list of plot_data dicts. With several figures and a plotly version that
+# has write_images, all PNGs are rendered in one Kaleido call.
+def write_figures(data_list, images_dir, png=True, pretty_json=True):
+    os.makedirs(images_dir, exist_ok=True)
+    figs = [f for data in data_list for f in allele_figures(data, images_dir)]
+    for fig, output_name in figs:
+        with open(output_name + '.json', 'w') as f:
+            f.write(fig.to_json(pretty=pretty_json))
+    if png and figs:
+        if hasattr(pio, "write_images") and len(figs) > 1:
+            pio.write_images([fig for fig, _ in figs], [name + '.png' for _, name in figs])
+        else:
+            for fig, output_name in figs:
+                fig.write_image(output_name + '.png')
+
+
+# Renders figures in a background thread, so that evaluation does not wait
+# for Kaleido. One thread keeps a single Kaleido session; plot data is
+# written in batches of batch_size alleles. close() (or leaving a with
+# block) writes the remaining figures and re-raises the first error.
+class FigureWriter(object):
+
+    def __init__(self, images_dir, png=True, pretty_json=True, batch_size=8, workers=1):
+        self.images_dir = images_dir
+        self.png = png
+        self.pretty_json = pretty_json
+        self.batch_size = batch_size
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = []
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, data):
+        with self.lock:
+            self.pending.append(data)
+            if len(self.pending) < self.batch_size:
+                return
+            batch, self.pending = self.pending, []
+        self.futures.append(self.pool.submit(write_figures, batch, self.images_dir,
+                                             png=self.png, pretty_json=self.pretty_json))
+
+    def close(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if batch:
+            self.futures.append(self.pool.submit(write_figures, batch, self.images_dir,
+                                                 png=self.png, pretty_json=self.pretty_json))
+        self.pool.shutdown(wait=True)
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
@@ -1,22 +1,26 @@
 import os
+import copy
+import time
+import functools
+import hashlib
+import contextlib
+import cProfile
+import tracemalloc
 import pandas
 import numpy
 import scipy
 import scipy.stats
-import statsmodels.sandbox.stats.multicomp as stats_models
+import statsmodels.stats.multitest as stats_models
 import random
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import correlations as corr
-from plotly import graph_objects as go
-from plotly.subplots import make_subplots
-from plotly import express as px
-import pandas
+import figures
+from figures import CMAP_TYPE
 
 H0 = "There is no difference between replicate self correlation and control correlation"
 random.seed(8)
 
-CMAP_TYPE = {'EMPTY': '#1f77b4', 'REF':'#2CA02C',
-             'VAR': '#FF7F0E', 'VAR_REF': '#8C564B'}
-
 
 def wilcoxon_test(self_corr_matrix, control_corr_matrix):
     self_corr_median = corr.correlation_median_row(self_corr_matrix)
@@ -42,6 +46,402 @@ def kruskal_wallis_on_medians(self_corr_matrix, control_corr_matrix):
     return test_result.pvalue
 
 
+## BATCHED TESTS
+## The following functions run one test per row of their (K x n) inputs.
+## They follow the normal / chi-square approximations used by scipy.
+
+# Wilcoxon rank-sum test of every row of sample1 against the same row of
+# sample2. sample2 can also be a 1-D array shared by all rows.
+def ranksums_batch(sample1, sample2):
+    sample1 = numpy.atleast_2d(sample1)
+    sample2 = numpy.asarray(sample2, dtype=float)
+    if sample2.ndim == 1:
+        sample2 = numpy.broadcast_to(sample2, (sample1.shape[0], len(sample2)))
+    n1, n2 = sample1.shape[1], sample2.shape[1]
+    ranks = scipy.stats.rankdata(numpy.concatenate([sample1, sample2], axis=1), axis=1)
+    s = ranks[:, 0:n1].sum(axis=1)
+    expected = n1 * (n1 + n2 + 1) / 2.0
+    z = (s - expected) / numpy.sqrt(n1 * n2 * (n1 + n2 + 1) / 12.0)
+    return 2 * scipy.stats.norm.sf(numpy.abs(z))
+
+
+# Kruskal-Wallis H-test on every row of the (K x n_i) samples, with the
+# tie correction. Rows where all values are identical get a NaN p-value.
+def kruskal_batch(*samples):
+    samples = [numpy.atleast_2d(x) for x in samples]
+    sizes = numpy.asarray([x.shape[1] for x in samples])
+    values = numpy.concatenate(samples, axis=1)
+    n = values.shape[1]
+    ranks = scipy.stats.rankdata(values, axis=1)
+    bounds = numpy.concatenate([[0], numpy.cumsum(sizes)])
+    h = sum(ranks[:, a:b].sum(axis=1)**2 / (b - a) for a, b in zip(bounds[:-1], bounds[1:]))
+    h = 12.0 / (n * (n + 1)) * h - 3 * (n + 1)
+    # Each value in a group of t ties contributes t^2 - 1, so a group adds t^3 - t
+    ties = scipy.stats.rankdata(values, method="max", axis=1) - scipy.stats.rankdata(values, method="min", axis=1) + 1
+    correction = 1 - (ties**2 - 1).sum(axis=1) / float(n**3 - n)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        h = numpy.where(correction > 0, h / correction, numpy.nan)
+    return scipy.stats.chi2.sf(h, len(samples) - 1)
+
+
+# Null distribution of the signed-rank statistic for n pairs without ties:
+# number of subsets of the ranks 1..n with every sum, over 2^n
+@functools.lru_cache(maxsize=64)
+def signed_rank_distribution(n):
+    counts = numpy.zeros(n * (n + 1) // 2 + 1)
+    counts[0] = 1
+    for rank in range(1, n + 1):
+        counts[rank:] = counts[rank:] + counts[:-rank]
+    return counts / 2.0**n
+
+
+# Wilcoxon signed-rank test (wilcoxon_test) on each of the K resamples of
+# (K x n x n) self correlations and (K x n x c) control correlations. Like
+# scipy, samples of up to 50 pairs use the exact distribution and larger
+# ones the normal approximation. Rows with zero differences or ties, for
+# which scipy switches to other methods, are passed to scipy one by one.
+def wilcoxon_test_batch(self_corr_matrices, control_corr_matrices):
+    x = corr.correlation_median_row(self_corr_matrices)
+    y = numpy.median(control_corr_matrices, axis=-1)
+    d = x - y
+    n = d.shape[1]
+    magnitudes = numpy.abs(d)
+    ranks = scipy.stats.rankdata(magnitudes, axis=1)
+    r_plus = numpy.where(d > 0, ranks, 0).sum(axis=1)
+    if n <= 50:
+        pmf = signed_rank_distribution(n)
+        k = numpy.rint(r_plus).astype(int)
+        cdf = numpy.cumsum(pmf)[k]
+        sf = numpy.cumsum(pmf[::-1])[::-1][k]
+        pvalues = numpy.clip(2 * numpy.minimum(sf, cdf), 0, 1)
+    else:
+        z = (r_plus - n * (n + 1) / 4.0) / numpy.sqrt(n * (n + 1) * (2 * n + 1) / 24.0)
+        pvalues = 2 * scipy.stats.norm.sf(numpy.abs(z))
+    ordered = numpy.sort(magnitudes, axis=1)
+    special = (ordered[:, 0] == 0) | numpy.any(ordered[:, 1:] == ordered[:, :-1], axis=1)
+    for i in numpy.flatnonzero(special):
+        pvalues[i] = scipy.stats.wilcoxon(x[i], y[i]).pvalue
+    return pvalues
+
+
+# Draw n_resamples subsets of index, one per row of the returned array.
+# If there are not more than samples indices, all of them are used.
+def sample_index_sets(index, samples, n_resamples, rng):
+    index = numpy.asarray(index)
+    if len(index) <= samples:
+        return numpy.tile(index, (n_resamples, 1))
+    order = numpy.argsort(rng.random((n_resamples, len(index))), axis=1)
+    return index[order[:, 0:samples]]
+
+
+# Summarize the p-values of K resamples: the median p-value is reported
+# as the test result, and the stability is the fraction of resamples that
+# are significant at alpha.
+def summarize_resamples(results, test_name, pvalues, alpha):
+    results[test_name] = numpy.nanmedian(pvalues)
+    results[test_name + "_stability"] = numpy.mean(pvalues < alpha)
+    return results
+
+
+# Shuffle a list of indices with the random module or a numpy Generator
+def shuffle_index(index, rng=None):
+    if rng is None:
+        index = list(index)
+        random.shuffle(index)
+        return index
+    return list(rng.permutation(numpy.asarray(index)))
+
+
+## PERMUTATION TESTS
+## Empirical p-values for the tests of Morphology_VIP_CNN_Features. The
+## pooled values are ranked once, so under a shuffle of the group labels
+## every statistic is a function of the sums of ranks per group. Labels of
+## B permutations are drawn in (chunk x n) arrays and their rank sums are
+## computed with one matrix product per group. Every allele gets its own
+## random stream: with the same shuffles for all alleles, their p-values
+## would be correlated, which the BH step of adjust_pvalues assumes not.
+
+# Labels 0..G-1 of groups of the given sizes, in order. Shuffled copies of
+# it are the permutations.
+@functools.lru_cache(maxsize=16)
+def permutation_labels(sizes):
+    labels = numpy.repeat(numpy.arange(len(sizes), dtype=numpy.int8), sizes)
+    labels.flags.writeable = False
+    return labels
+
+
+# Random stream of the permutations of one allele, derived from seed and the
+# allele names, so that it does not depend on the order of the alleles or on
+# how they are batched
+def allele_seed(seed, wild_type, mutant):
+    digest = hashlib.sha1(f"{wild_type}\t{mutant}".encode()).digest()
+    return numpy.random.SeedSequence(seed, spawn_key=tuple(numpy.frombuffer(digest[0:8], dtype=numpy.uint32).tolist()))
+
+
+# Sum of ranks of every group: ranks is (A x n), labels (B x n), the
+# result is (A x B x G)
+def group_rank_sums(ranks, labels, n_groups, chunk_size=1000):
+    sums = numpy.empty((ranks.shape[0], labels.shape[0], n_groups))
+    for start in range(0, labels.shape[0], chunk_size):
+        block = labels[start:start + chunk_size]
+        for g in range(n_groups - 1):
+            sums[:, start:start + len(block), g] = numpy.dot(ranks, (block == g).T.astype(ranks.dtype))
+    sums[..., -1] = ranks.sum(axis=1)[:, numpy.newaxis] - sums[..., :-1].sum(axis=-1)
+    return sums
+
+
+# Sums of ranks of every group under n_permutations shuffles drawn from
+# rng: ranks is a 1-D array, the result is (B x G)
+def permutation_rank_sums(ranks, sizes, n_permutations, rng, chunk_size=1000):
+    labels = permutation_labels(tuple(sizes))
+    sums = numpy.empty((n_permutations, len(sizes)))
+    for start in range(0, n_permutations, chunk_size):
+        block = rng.permuted(numpy.tile(labels, (min(chunk_size, n_permutations - start), 1)), axis=1)
+        sums[start:start + len(block)] = group_rank_sums(ranks[numpy.newaxis], block, len(sizes))[0]
+    return sums
+
+
+# Kruskal-Wallis H up to constants that do not change under permutations
+def kruskal_rank_statistic(sums, sizes):
+    return (sums**2 / sizes).sum(axis=-1)
+
+
+# Two-sided Wilcoxon rank-sum statistic of the first group
+def ranksums_rank_statistic(sums, sizes):
+    return numpy.abs(sums[..., 0] - sizes[0] * (sizes.sum() + 1) / 2.0)
+
+
+# Permutation p-value of every row of the samples. Each sample is (A x n_g),
+# or 1-D if it is shared by all rows (e.g. the null distribution). seeds is
+# one seed (or SeedSequence) per row, or a single seed from which
+# independent streams are spawned for the rows.
+def permutation_test(samples, statistic, n_permutations=10000, seeds=0):
+    rows = [len(x) for x in samples if numpy.ndim(x) == 2]
+    A = max(rows) if rows else 1
+    samples = [numpy.broadcast_to(numpy.asarray(x, dtype=float), (A, numpy.shape(x)[-1])) for x in samples]
+    sizes = numpy.asarray([x.shape[1] for x in samples])
+    ranks = scipy.stats.rankdata(numpy.concatenate(samples, axis=1), axis=1)
+    observed_labels = permutation_labels(tuple(sizes.tolist()))[numpy.newaxis]
+    observed = statistic(group_rank_sums(ranks, observed_labels, len(sizes)), sizes)
+    if not isinstance(seeds, (list, tuple)):
+        seeds = numpy.random.SeedSequence(seeds).spawn(A)
+    permuted = numpy.stack([statistic(permutation_rank_sums(ranks[a], sizes.tolist(), n_permutations,
+                                                            numpy.random.default_rng(seeds[a])), sizes)
+                            for a in range(A)])
+    # Ties with the observed statistic count as extreme, up to rounding
+    extreme = (permuted >= observed - 1e-9 * numpy.maximum(1, numpy.abs(observed))).sum(axis=1)
+    return (1.0 + extreme) / (n_permutations + 1.0)
+
+
+## P-VALUE ADJUSTMENT
+## Benjamini-Hochberg adjustment of the tests of test_allele_set and
+## Variant-Impact Phenotyping predictions. They only read the result
+## columns, so they can run on saved results without a Morphology_VIP.
+
+# Adjusted p-values and significance at FDR Q of every test field
+def fdr_adjust(results, test_fields, Q=0.05):
+    for f in test_fields:
+        sig, adj, a, b = stats_models.multipletests(results[f], alpha=Q, method="fdr_bh")
+        results["is_sig_" + f] = sig
+        results["adjusted_" + f] = adj
+    return results
+
+
+# Results of Morphology_VIP
+def adjust_morphology_pvalues(results, Q=0.05):
+    fdr_adjust(results, ["wt_has_effect", "mut_has_effect", "wt_mut_difference"], Q=Q)
+
+    # Run the Variant-Impact Phenotyping test
+    wt_has_effect = results["is_sig_wt_has_effect"]
+    mut_has_effect = results["is_sig_mut_has_effect"]
+    wt_mut_diff = results["is_sig_wt_mut_difference"]
+
+    results["prediction"] = "NI"
+    results.loc[~ wt_has_effect & mut_has_effect, "prediction"] = "GOF"
+    results.loc[wt_has_effect & ~ mut_has_effect, "prediction"] = "LOF"
+    results.loc[wt_has_effect & mut_has_effect & wt_mut_diff, "prediction"] = "COF"
+    results.loc[wt_has_effect & mut_has_effect & ~ wt_mut_diff, "prediction"] = "NT"
+
+    return results
+
+
+# Results of Morphology_VIP_CNN_Features
+def adjust_cnn_feature_pvalues(results, Q=0.05):
+    fdr_adjust(results, ["impact_test", "strength_test", "power_test"], Q=Q)
+
+    # Run the Variant-Impact Phenotyping test
+    impact_test = results["is_sig_impact_test"]
+    strength_test = results["is_sig_strength_test"]
+    power_test = results["is_sig_power_test"]
+    direction_test = results["directionality_test"] > 0.0
+
+    results["prediction"] = "NI"
+    results.loc[impact_test & strength_test & direction_test , "prediction"] = "GOF"
+    results.loc[impact_test & strength_test & ~direction_test, "prediction"] = "LOF"
+    results.loc[impact_test & ~ strength_test, "prediction"] = "COF"
+    results.loc[~impact_test & power_test, "prediction"] = "NT"
+
+    return results
+
+
+## INSTRUMENTATION
+## With Morphology_VIP(instrument=True) every evaluate call gets a StageTimer
+## that accumulates wall time per stage and counters. When instrumentation is
+## disabled, NO_TIMER is used and every stage is a shared null context.
+
+TIMING_STAGES = ["total", "sampling", "gathers", "tests", "plotting", "index"]
+
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def record(self, wild_type, mutant):
+        record = {"wild_type": wild_type, "mutant": mutant}
+        record.update(self.times)
+        record.update(self.counts)
+        return record
+
+
+class _NullTimer(object):
+
+    _context = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self._context
+
+    def count(self, name, n=1):
+        pass
+
+
+NO_TIMER = _NullTimer()
+
+
+# Per-allele timing table: one row per evaluated allele, seconds per stage
+# and counters
+def timing_table(records):
+    table = pandas.DataFrame.from_records(records)
+    extra = [c for c in table.columns if c not in ["wild_type", "mutant"] + TIMING_STAGES]
+    return table.reindex(columns=["wild_type", "mutant"] + TIMING_STAGES + extra)
+
+
+## Profiling hooks for Morphology_VIP(profile_hook=...). A hook is called
+## with (wild_type, mutant, timer) before an allele is evaluated and returns
+## a context manager that wraps the evaluation, or None to skip the allele.
+## Hooks are classes so that they can be sent to worker processes.
+
+# Run cProfile on the selected mutants (all if None) and write
+# <output_dir>/<mutant>.prof, to be read with pstats or snakeviz
+class CProfileHook(object):
+
+    def __init__(self, output_dir, alleles=None):
+        self.output_dir = output_dir
+        self.alleles = alleles
+
+    @contextlib.contextmanager
+    def _profile(self, mutant):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            os.makedirs(self.output_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.output_dir, mutant + ".prof"))
+
+    def __call__(self, wild_type, mutant, timer):
+        if self.alleles is not None and mutant not in self.alleles:
+            return None
+        return self._profile(mutant)
+
+
+# Trace memory allocations of the selected mutants (all if None) and add
+# the peak in bytes to the timing table as "peak_bytes"
+class TracemallocHook(object):
+
+    def __init__(self, alleles=None):
+        self.alleles = alleles
+
+    @contextlib.contextmanager
+    def _trace(self, timer):
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            timer.count("peak_bytes", tracemalloc.get_traced_memory()[1])
+            if started:
+                tracemalloc.stop()
+
+    def __call__(self, wild_type, mutant, timer):
+        if self.alleles is not None and mutant not in self.alleles:
+            return None
+        return self._trace(timer)
+
+
+## PARALLEL EVALUATION
+## Worker processes receive the correlation matrix as a shared memory block
+## (or reopen it if it is a memmap) instead of a pickled copy per task.
+
+_worker = {}
+
+
+def share_matrix(matrix):
+    if isinstance(matrix, numpy.memmap) and matrix.filename is not None:
+        spec = ("memmap", matrix.filename, matrix.dtype.str, matrix.shape, matrix.offset)
+        return None, spec
+    if isinstance(matrix, numpy.ndarray):
+        handle = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+        shared = numpy.ndarray(matrix.shape, dtype=matrix.dtype, buffer=handle.buf)
+        shared[...] = matrix
+        spec = ("shm", handle.name, matrix.dtype.str, matrix.shape, 0)
+        return handle, spec
+    # Any other matrix-like object is pickled once per worker
+    return None, ("object", matrix)
+
+
+def attach_matrix(spec):
+    kind = spec[0]
+    if kind == "object":
+        return None, spec[1]
+    _, name, dtype, shape, offset = spec
+    if kind == "memmap":
+        return None, numpy.memmap(name, dtype=dtype, mode="r", shape=shape, offset=offset)
+    handle = shared_memory.SharedMemory(name=name)
+    return handle, numpy.ndarray(shape, dtype=dtype, buffer=handle.buf)
+
+
+def _init_worker(vip, matrix_spec, options):
+    handle, vip.corr_matrix = attach_matrix(matrix_spec)
+    _worker["handle"] = handle
+    _worker["vip"] = vip
+    _worker["options"] = options
+
+
+def _evaluate_worker(task, stream):
+    wild_type, mutant = task
+    vip = _worker["vip"]
+    rng = numpy.random.default_rng(stream)
+    timer = StageTimer() if vip.instrument else NO_TIMER
+    record = vip._evaluate_timed(wild_type, mutant, timer, rng=rng, **_worker["options"])
+    return record, timer.record(wild_type, mutant) if vip.instrument else None
+
+
 ## Matrices required for eVIP
 ## A. Wild type vs Wild type 	= Wild type self-correlation 	= wt_wt
 ## B. Mutant vs Mutant 		= Mutant self-correlation 	= mut_mut
@@ -51,84 +451,201 @@ def kruskal_wallis_on_medians(self_corr_matrix, control_corr_matrix):
 
 class Morphology_VIP(object):
 
-    def __init__(self, metadata, corr_matrix, treatment_samples, control_samples, controls_value="control", perturbation_field="Metadata_x_mutation_status", controls_field="Metadata_broad_sample_type", plate_field="Metadata_Plate"):
+    test_cols = ["wild_type", "wt_samples", "mutant", "mut_samples", "wt_has_effect", "mut_has_effect", "wt_mut_difference"]
+
+    def __init__(self, metadata, corr_matrix, treatment_samples, control_samples, controls_value="control", perturbation_field="Metadata_x_mutation_status", controls_field="Metadata_broad_sample_type", plate_field="Metadata_Plate",
+                 n_resamples=1, stability_alpha=0.05, instrument=False, profile_hook=None, figure_options=None):
         self.metadata = metadata
         self.corr_matrix = corr_matrix
         self.treatment_samples = treatment_samples
         self.control_samples = control_samples
         self.ctl_mask = metadata[controls_field] == controls_value
+        self.control_table = corr.control_index_table(metadata, plate_field, self.ctl_mask)
         self.perturbation_field = perturbation_field
         self.plate_field = plate_field
-        self.index = {"name": "genes", "children": []}
-        self.test_cols = ["wild_type", "wt_samples", "mutant", "mut_samples", "wt_has_effect", "mut_has_effect", "wt_mut_difference"]
+        # Rows of every perturbation and wild type candidates of every gene,
+        # so that per-allele lookups do not scan the metadata
+        codes, values = pandas.factorize(metadata[perturbation_field])
+        self.perturbation_codes = codes
+        self.perturbation_values = values
+        groups = pandas.Series(codes).groupby(codes).indices
+        self.perturbation_rows = {values[c]: rows for c, rows in groups.items() if c >= 0}
+        self.wild_type_candidates = {}
+        for value in values:
+            if isinstance(value, str):
+                self.wild_type_alternatives(value.split("_")[0] + "_WT")
+        # With n_resamples > 1 every allele is tested on that many random draws
+        # of replicates and controls (see evaluate_resampled)
+        self.n_resamples = n_resamples
+        self.stability_alpha = stability_alpha
+        # wild type -> mutant -> index entry, exported by the index property
+        self.allele_index = {}
+        self.index_sorted = False
+        # Per-stage timings of every evaluate call (see StageTimer), and an
+        # optional hook to profile selected alleles (see CProfileHook)
+        self.instrument = instrument
+        self.profile_hook = profile_hook
+        self.timing_records = []
+        # Set by test_allele_set while it evaluates alleles
+        self.defer_tests = False
+        # Figure export: png=False skips PNG files, pretty_json=False writes
+        # compact JSON, max_size downsamples the heatmaps and background=False
+        # renders figures inline instead of in a FigureWriter
+        self.figure_options = dict(figure_options or {})
+        self.figure_writer = None
 
 
     def evaluate(self, wild_type, mutant, create_images=False, false_positives=False,
-                 images_dir='./'):
+                 images_dir='./', rng=None):
+        timer = StageTimer() if self.instrument else NO_TIMER
+        results = self._evaluate_timed(wild_type, mutant, timer, create_images=create_images,
+                                       false_positives=false_positives, images_dir=images_dir, rng=rng)
+        with timer.stage("index"):
+            self.add_to_index(wild_type, mutant)
+        if self.instrument:
+            self.timing_records.append(timer.record(wild_type, mutant))
+        return results
+
+    # evaluate_allele inside the profiling hook, if any
+    def _evaluate_timed(self, wild_type, mutant, timer, **options):
+        hook = None
+        if self.profile_hook is not None:
+            hook = self.profile_hook(wild_type, mutant, timer)
+        with hook or contextlib.nullcontext():
+            with timer.stage("total"):
+                return self.evaluate_allele(wild_type, mutant, timer=timer, **options)
+
+    # Sample replicates, copy matrices and run the tests for one allele.
+    # Unlike evaluate, this does not modify the object, so it can run in a
+    # worker process. rng is an optional numpy Generator; by default the
+    # random module is used.
+    # timer is an optional StageTimer.
+    def evaluate_allele(self, wild_type, mutant, create_images=False, false_positives=False,
+                        images_dir='./', rng=None, timer=NO_TIMER):
+        if self.n_resamples > 1:
+            return self.evaluate_resampled(wild_type, mutant, create_images=create_images,
+                                           false_positives=false_positives, images_dir=images_dir, rng=rng,
+                                           timer=timer)
         results = {}
         results["wild_type"] = wild_type
         results["mutant"] = mutant
-        # Get indices of data
-        wt_mask = self.metadata[self.perturbation_field] == wild_type
-        wt_index = self.metadata[wt_mask].index
-        mut_mask = self.metadata[self.perturbation_field] == mutant
-        mut_index = self.metadata[mut_mask].index
-
-        if not false_positives: # Regular evaluation
-            if len(mut_index) > self.treatment_samples:
-                mut_index = list(mut_index)
-                random.shuffle(mut_index)
-                mut_index = mut_index[0:self.treatment_samples]
-            if len(wt_index) > self.treatment_samples:
-                wt_index = list(wt_index)
-                random.shuffle(wt_index)
-                wt_index = wt_index[0:self.treatment_samples]
-        else: # False positives evaluation
-            tmp_index = list(mut_index)
-            random.shuffle(tmp_index)
-            mut_index = tmp_index[0:self.treatment_samples]
-            wt_index = tmp_index[-self.treatment_samples:]
+        with timer.stage("sampling"):
+            # Get indices of data
+            wt_index = self.perturbation_index(wild_type)
+            mut_index = self.perturbation_index(mutant)
+
+            if not false_positives: # Regular evaluation
+                if len(mut_index) > self.treatment_samples:
+                    mut_index = shuffle_index(mut_index, rng)[0:self.treatment_samples]
+                if len(wt_index) > self.treatment_samples:
+                    wt_index = shuffle_index(wt_index, rng)[0:self.treatment_samples]
+            else: # False positives evaluation
+                tmp_index = shuffle_index(mut_index, rng)
+                mut_index = tmp_index[0:self.treatment_samples]
+                wt_index = tmp_index[-self.treatment_samples:]
 
         results["wt_samples"] = len(wt_index)
         results["mut_samples"] = len(mut_index)
-        # Copy matrices
-        self.wt_wt = corr.sample_rectangular_matrix(wt_index, wt_index, self.corr_matrix)
-        self.mut_mut = corr.sample_rectangular_matrix(mut_index, mut_index, self.corr_matrix)
-        self.wt_ctl = corr.allele_to_control_matrix(wt_index, self.metadata, self.plate_field, self.ctl_mask, self.control_samples, self.corr_matrix)
-        self.mut_ctl = corr.allele_to_control_matrix(mut_index, self.metadata, self.plate_field, self.ctl_mask, self.control_samples, self.corr_matrix)
-        self.wt_mut = corr.sample_rectangular_matrix(wt_index, mut_index, self.corr_matrix)
-
-        # Add json index entry
-        # search for wild_type
-        wt_idx = [x for x in range(len(self.index["children"])) if self.index["children"][x]["name"] == wild_type ]
-        if len(wt_idx) == 0:
-            self.index["children"].append({"name": wild_type, "children": []})
-            wt_idx = -1
-        else:
-            wt_idx = wt_idx[0]
-        self.index["children"][wt_idx]["children"].append({"name": mutant, "pair": wild_type + "_" + mutant})
+        # Copy matrices (control matrices include sampling the controls)
+        with timer.stage("gathers"):
+            matrices = {}
+            matrices["wt_wt"] = corr.sample_rectangular_matrix(wt_index, wt_index, self.corr_matrix)
+            matrices["mut_mut"] = corr.sample_rectangular_matrix(mut_index, mut_index, self.corr_matrix)
+            matrices["wt_ctl"] = corr.allele_to_control_matrix(wt_index, self.metadata, self.plate_field, self.ctl_mask, self.control_samples, self.corr_matrix,
+                                                               control_table=self.control_table, rng=rng)
+            matrices["mut_ctl"] = corr.allele_to_control_matrix(mut_index, self.metadata, self.plate_field, self.ctl_mask, self.control_samples, self.corr_matrix,
+                                                                control_table=self.control_table, rng=rng)
+            matrices["wt_mut"] = corr.sample_rectangular_matrix(wt_index, mut_index, self.corr_matrix)
+        timer.count("gathered", sum(m.size for m in matrices.values()))
 
         # Run tests
         if create_images:
-            self.create_plots(results, images_dir)
-        return self.statistical_tests_medians(results)
+            with timer.stage("plotting"):
+                self.create_plots(results, images_dir, matrices)
+        with timer.stage("tests"):
+            return self.statistical_tests_medians(results, matrices)
+
+    # Monte-Carlo version of evaluate_allele: draws n_resamples sets of
+    # replicates and controls at once as (K x n) index arrays, gathers the K
+    # sub-matrices of each type in one indexing operation and runs the
+    # tests vectorized across resamples.
+    def evaluate_resampled(self, wild_type, mutant, create_images=False, false_positives=False,
+                           images_dir='./', rng=None, timer=NO_TIMER):
+        if rng is None:
+            rng = numpy.random.default_rng(random.randrange(2**32))
+        K = self.n_resamples
+        results = {}
+        results["wild_type"] = wild_type
+        results["mutant"] = mutant
+        with timer.stage("sampling"):
+            wt_index = self.perturbation_index(wild_type)
+            mut_index = self.perturbation_index(mutant)
+
+            if not false_positives:
+                wt_sets = sample_index_sets(wt_index, self.treatment_samples, K, rng)
+                mut_sets = sample_index_sets(mut_index, self.treatment_samples, K, rng)
+            else:
+                order = numpy.argsort(rng.random((K, len(mut_index))), axis=1)
+                tmp_sets = numpy.asarray(mut_index)[order]
+                mut_sets = tmp_sets[:, 0:self.treatment_samples]
+                wt_sets = tmp_sets[:, -self.treatment_samples:]
+
+            ctl_sets = {}
+            for name, sets in [("wt_ctl", wt_sets), ("mut_ctl", mut_sets)]:
+                plates = self.metadata.loc[sets.ravel(), self.plate_field].to_numpy()
+                ctl_idx = corr.sample_control_index(plates, self.control_table, self.control_samples, rng=rng)
+                ctl_sets[name] = ctl_idx.reshape(K, sets.shape[1], -1)
+
+        results["wt_samples"] = wt_sets.shape[1]
+        results["mut_samples"] = mut_sets.shape[1]
+        with timer.stage("gathers"):
+            matrices = {}
+            matrices["wt_wt"] = self.corr_matrix[wt_sets[:, :, numpy.newaxis], wt_sets[:, numpy.newaxis, :]]
+            matrices["mut_mut"] = self.corr_matrix[mut_sets[:, :, numpy.newaxis], mut_sets[:, numpy.newaxis, :]]
+            matrices["wt_mut"] = self.corr_matrix[wt_sets[:, :, numpy.newaxis], mut_sets[:, numpy.newaxis, :]]
+            matrices["wt_ctl"] = self.corr_matrix[wt_sets[:, :, numpy.newaxis], ctl_sets["wt_ctl"]]
+            matrices["mut_ctl"] = self.corr_matrix[mut_sets[:, :, numpy.newaxis], ctl_sets["mut_ctl"]]
+        timer.count("gathered", sum(m.size for m in matrices.values()))
 
-    def statistical_tests(self, results):
+        if create_images:
+            with timer.stage("plotting"):
+                self.create_plots(results, images_dir, {k: m[0] for k, m in matrices.items()})
+        with timer.stage("tests"):
+            return self.statistical_tests_resampled(results, matrices)
+
+    # Add json index entry
+    def add_to_index(self, wild_type, mutant):
+        mutants = self.allele_index.setdefault(wild_type, {})
+        if mutant not in mutants:
+            mutants[mutant] = {"name": mutant, "pair": wild_type + "_" + mutant}
+
+    # Index of evaluated alleles in the {"name", "children"} JSON format,
+    # sorted by name once results have been added with update_index
+    @property
+    def index(self):
+        order = sorted if self.index_sorted else list
+        children = []
+        for wild_type in order(self.allele_index):
+            mutants = self.allele_index[wild_type]
+            children.append({"name": wild_type, "children": [mutants[m] for m in order(mutants)]})
+        return {"name": "genes", "children": children}
+
+    def statistical_tests(self, results, matrices):
         iu = numpy.triu_indices(self.treatment_samples, 1)
-        results["wt_has_effect"] = kruskal_wallis_test(self.wt_wt[iu], self.wt_ctl)
-        results["mut_has_effect"] = kruskal_wallis_test(self.mut_mut[iu], self.mut_ctl)
-        results["wt_mut_difference"] = kruskal_wallis_test(self.wt_wt[iu], self.wt_mut)
+        results["wt_has_effect"] = kruskal_wallis_test(matrices["wt_wt"][iu], matrices["wt_ctl"])
+        results["mut_has_effect"] = kruskal_wallis_test(matrices["mut_mut"][iu], matrices["mut_ctl"])
+        results["wt_mut_difference"] = kruskal_wallis_test(matrices["wt_wt"][iu], matrices["wt_mut"])
         return results
         
 
-    def statistical_tests_medians(self, results):
-        wt_pvalue = wilcoxon_test(self.wt_wt, self.wt_ctl)
-        mut_pvalue = wilcoxon_test(self.mut_mut, self.mut_ctl)
+    def statistical_tests_medians(self, results, matrices):
+        wt_pvalue = wilcoxon_test(matrices["wt_wt"], matrices["wt_ctl"])
+        mut_pvalue = wilcoxon_test(matrices["mut_mut"], matrices["mut_ctl"])
         results["wt_has_effect"] = wt_pvalue
         results["mut_has_effect"] = mut_pvalue
 
         # Fix (see next comment):
-        wt_mut_pvalue = wilcoxon_test(self.mut_mut, self.wt_mut)
+        wt_mut_pvalue = wilcoxon_test(matrices["mut_mut"], matrices["wt_mut"])
         results["wt_mut_difference"] = wt_mut_pvalue
         return results
 
@@ -136,9 +653,9 @@ class Morphology_VIP(object):
         # the distribution of medians in the mutant matrix vs the distribution of median rows AND columns in the cross correlation matrix.
         # Using both, rows and columns is useful if we compare mut_mut VS wt_wt VS wt_mut. i.e., when we compare three distributions.
         # In the current version of the test, we can pair mut_mut medians with wt_mut medians in a Wilconxon test (right?)
-        self_corr_median = corr.correlation_median_row(self.mut_mut)
-        cross_corr_row = numpy.median(self.wt_mut, axis=0)
-        cross_corr_col = numpy.median(self.wt_mut, axis=1)
+        self_corr_median = corr.correlation_median_row(matrices["mut_mut"])
+        cross_corr_row = numpy.median(matrices["wt_mut"], axis=0)
+        cross_corr_col = numpy.median(matrices["wt_mut"], axis=1)
         test_result = scipy.stats.kruskal(self_corr_median, numpy.concatenate([cross_corr_row, cross_corr_col]))
         wt_mut_pvalue = test_result.pvalue
         results["wt_mut_difference"] = wt_mut_pvalue
@@ -146,66 +663,55 @@ class Morphology_VIP(object):
         return results
 
 
-    def create_plots(self, results, images_dir):
-        # Dot plots
-        row = numpy.median(self.wt_mut, axis=0)
-        col = numpy.median(self.wt_mut, axis=1)
-        cross_corr_median = numpy.concatenate([row, col])
-        dots = pandas.DataFrame()
-        # dots = dots.append( [{"Sample":"REF_CTL","Correlation":k} for k in numpy.median(self.wt_ctl, axis=1)] )
-        dots = dots.append( [{"Sample":"REF","Correlation":k} for k in corr.correlation_median_row(self.wt_wt)] )
-        dots = dots.append( [{"Sample":"VAR_REF","Correlation":k} for k in cross_corr_median] )
-        dots = dots.append( [{"Sample":"VAR","Correlation":k} for k in corr.correlation_median_row(self.mut_mut)] )
-        # dots = dots.append( [{"Sample":"VAR_CTL","Correlation":k} for k in numpy.median(self.mut_ctl, axis=1)] )
-
-        fig = px.box(dots, x='Sample', y='Correlation', color='Sample',
-                     points='all', color_discrete_map=CMAP_TYPE)
-        fig.update_layout(showlegend=False,
-                          yaxis_range=(-0.2, 1.0),
-                          # margin=dict(l=0, r=0, t=0, b=0)
-                          )
-
-        output_name = results["mutant"] + "_dots"
-        output_name = os.path.join(images_dir, output_name)
-        fig.write_image(output_name + '.png')
-        with open(output_name + '.json', 'w') as f:
-            f.write(fig.to_json(pretty=True))
-
-        # Matrix plots
-        matrices = [self.wt_wt, self.wt_mut, self.mut_mut]
-        samples = ["REF_REF", "VAR_REF", "VAR_VAR"]
-
-        # zmin, zmax = min(map(numpy.min, matrices)), max(map(numpy.max, matrices))
-        # zmin, zmax = dots.Correlation.min(), dots.Correlation.max()
-        zmin, zmax = -0.2, 1.0
-        zranges = {'zmin': zmin, 'zmax': zmax}
-        os.makedirs(images_dir, exist_ok=True)
-        fig = make_subplots(rows=1, cols=3, horizontal_spacing=0.05, subplot_titles=samples)
-        for i, matrix in enumerate(matrices, 1):
-            scaled_matrix = (numpy.clip(matrix, zmin, zmax) - zmin) / (zmax - zmin)
-            hmap = go.Heatmap(z=scaled_matrix,
-                              colorscale=[(0, "blue"), (0.5, "white"), (1, "red")],
-                              **zranges)
-            fig.add_trace(hmap, row=1, col=i)
-        fig.update_traces(showscale=False)
-        fig.update_xaxes(showticklabels=False)
-        fig.update_yaxes(showticklabels=False, autorange='reversed')
-        fig.update_layout(#margin=dict(l=0, r=0, t=30, b=0),
-                          height=340
-                          )
-
-        output_name = results["mutant"] + "_matrices"
-        output_name = os.path.join(images_dir, output_name)
-        fig.write_image(output_name + '.png')
-        with open(output_name + '.json', 'w') as f:
-            f.write(fig.to_json(pretty=True))
+    # Same tests as statistical_tests_medians on stacks of K matrices
+    def statistical_tests_resampled(self, results, matrices):
+        alpha = self.stability_alpha
+        wt_pvalues = wilcoxon_test_batch(matrices["wt_wt"], matrices["wt_ctl"])
+        mut_pvalues = wilcoxon_test_batch(matrices["mut_mut"], matrices["mut_ctl"])
+        wt_mut_pvalues = wilcoxon_test_batch(matrices["mut_mut"], matrices["wt_mut"])
+        summarize_resamples(results, "wt_has_effect", wt_pvalues, alpha)
+        summarize_resamples(results, "mut_has_effect", mut_pvalues, alpha)
+        summarize_resamples(results, "wt_mut_difference", wt_mut_pvalues, alpha)
+        return results
+
+    # Columns returned by test_allele_set
+    def result_cols(self):
+        if self.n_resamples > 1:
+            return self.test_cols + [c + "_stability" for c in self.test_cols[4:] if c != "directionality_test"]
+        return self.test_cols
+
+
+    # Plots are rendered in the background by self.figure_writer during
+    # test_allele_set, otherwise they are written before returning
+    def create_plots(self, results, images_dir, matrices):
+        options = self.figure_options
+        data = figures.plot_data(results, matrices, max_size=options.get("max_size"))
+        if self.figure_writer is not None:
+            self.figure_writer.submit(data)
+        else:
+            figures.write_figures([data], images_dir, png=options.get("png", True),
+                                  pretty_json=options.get("pretty_json", True))
+
+
+    # Index labels of the rows of one perturbation value
+    def perturbation_index(self, value):
+        rows = self.perturbation_rows.get(value)
+        if rows is None:
+            return self.metadata.index[0:0]
+        return self.metadata.index[rows]
 
+    # Perturbation values that contain wild_type (e.g. "KRAS_WT"), in order of
+    # appearance in the metadata
+    def wild_type_alternatives(self, wild_type):
+        if wild_type not in self.wild_type_candidates:
+            self.wild_type_candidates[wild_type] = [v for v in self.perturbation_values
+                                                    if isinstance(v, str) and wild_type in v]
+        return self.wild_type_candidates[wild_type]
 
     def search_wild_type(self, mutant, ignore_wt=False):
         # Search the corresponding wild type
         wild_type = mutant.split("_")[0] + "_WT"
-        wt_search = self.metadata[self.perturbation_field].str.find(wild_type) != -1
-        wt_alternatives = self.metadata[wt_search][self.perturbation_field].unique()
+        wt_alternatives = self.wild_type_alternatives(wild_type)
         if len(wt_alternatives) == 1:
             wild_type = wt_alternatives[0]
         elif len(wt_alternatives) > 1:
@@ -220,42 +726,101 @@ class Morphology_VIP(object):
         return wild_type
 
  
+    # Evaluate all alleles in the list against their wild types.
+    # With n_jobs > 1 the alleles are evaluated in a pool of worker processes
+    # that share the correlation matrix. Each allele gets its own random
+    # stream derived from seed, so results do not depend on the number of
+    # workers. If seed is None, the serial mode uses the random module as
+    # before and the parallel mode draws a seed from it.
+    # With instrument=True, the per-allele timing table of this call is kept
+    # in self.timings, and also returned if return_timings is True.
     def test_allele_set(self, alleles, create_images=False, false_positives=False, null_distribution=None,
-            images_dir='./'):
+            images_dir='./', n_jobs=1, seed=None, return_timings=False):
         self.null_dist = null_distribution
-        results = pandas.DataFrame()
+        first_record = len(self.timing_records)
+        tasks = []
         for mutant in alleles:
             wild_type = self.search_wild_type(mutant, ignore_wt=false_positives)
             if wild_type is not None:
-                r = self.evaluate(wild_type, mutant, create_images=create_images, false_positives=false_positives, images_dir=images_dir)
-                results = results.append(r, ignore_index=True)
-    
-        return results[self.test_cols]
+                tasks.append((wild_type, mutant))
 
+        if seed is None and n_jobs != 1:
+            seed = random.randrange(2**32)
+        if seed is not None:
+            streams = numpy.random.SeedSequence(seed).spawn(len(tasks))
+        else:
+            streams = [None] * len(tasks)
+        options = {"create_images": create_images, "false_positives": false_positives, "images_dir": images_dir}
+
+        # Tests that can run for all alleles at once (see complete_records)
+        # are deferred while the alleles are evaluated
+        self.defer_tests = True
+        try:
+            if n_jobs == 1:
+                records = []
+                if create_images and self.figure_options.get("background", True):
+                    self.figure_writer = figures.FigureWriter(
+                        images_dir, png=self.figure_options.get("png", True),
+                        pretty_json=self.figure_options.get("pretty_json", True),
+                        batch_size=self.figure_options.get("batch_size", 8))
+                try:
+                    for (wild_type, mutant), stream in zip(tasks, streams):
+                        rng = numpy.random.default_rng(stream) if stream is not None else None
+                        records.append(self.evaluate(wild_type, mutant, rng=rng, **options))
+                finally:
+                    # Wait for the remaining figures
+                    writer, self.figure_writer = self.figure_writer, None
+                    if writer is not None:
+                        writer.close()
+            else:
+                outputs = self._evaluate_parallel(tasks, streams, options, n_jobs)
+                records = [record for record, _ in outputs]
+                for (wild_type, mutant), (_, timing) in zip(tasks, outputs):
+                    timer = StageTimer() if self.instrument else NO_TIMER
+                    with timer.stage("index"):
+                        self.add_to_index(wild_type, mutant)
+                    if self.instrument:
+                        timing.update(timer.times)
+                        self.timing_records.append(timing)
+        finally:
+            self.defer_tests = False
+
+        records = self.complete_records(records)
+        results = pandas.DataFrame.from_records(records, columns=self.result_cols())
+        results = results[self.result_cols()]
+        if self.instrument:
+            self.timings = timing_table(self.timing_records[first_record:])
+            if return_timings:
+                return results, self.timings
+        return results
 
-    def adjust_pvalues(self, results, Q=0.05):
-        m = len(results)
-        test_fields = ["wt_has_effect", "mut_has_effect", "wt_mut_difference"]
-        all_tests = []
 
-        ## Adjust p-values of all tests
-        for f in test_fields:        
-            sig, adj, a, b = stats_models.multipletests(results[f], method="fdr_bh")
-            results["is_sig_" + f] = sig
-            results["adjusted_" + f] = adj
+    # Last step on the records of all alleles before they become a DataFrame
+    def complete_records(self, records):
+        return records
 
-        # Run the Variant-Impact Phenotyping test
-        wt_has_effect = results["is_sig_wt_has_effect"]
-        mut_has_effect = results["is_sig_mut_has_effect"]
-        wt_mut_diff = results["is_sig_wt_mut_difference"]
 
-        results["prediction"] = "NI"
-        results.loc[~ wt_has_effect & mut_has_effect, "prediction"] = "GOF"
-        results.loc[wt_has_effect & ~ mut_has_effect, "prediction"] = "LOF"
-        results.loc[wt_has_effect & mut_has_effect & wt_mut_diff, "prediction"] = "COF"
-        results.loc[wt_has_effect & mut_has_effect & ~ wt_mut_diff, "prediction"] = "NT"
-        
-        return results
+    def _evaluate_parallel(self, tasks, streams, options, n_jobs):
+        handle, matrix_spec = share_matrix(self.corr_matrix)
+        try:
+            # The correlation matrix is attached by the workers, the rest of
+            # the object is sent once per worker.
+            vip = copy.copy(self)
+            vip.corr_matrix = None
+            vip.timing_records = []
+            n_jobs = None if n_jobs == -1 else n_jobs
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                     initargs=(vip, matrix_spec, options)) as pool:
+                records = list(pool.map(_evaluate_worker, tasks, streams))
+        finally:
+            if handle is not None:
+                handle.close()
+                handle.unlink()
+        return records
+
+
+    def adjust_pvalues(self, results, Q=0.05):
+        return adjust_morphology_pvalues(results, Q=Q)
 
 
     def eval_pvalues(self, results, threshold=0.05):
@@ -281,15 +846,39 @@ class Morphology_VIP(object):
 
 class Morphology_VIP_CNN_Features(Morphology_VIP):
 
+    test_cols = ['wild_type', 'wt_samples', "mutant", 'mut_samples', 'impact_test', 'strength_test', 'directionality_test', 'power_test']
+
+    # test_engine="permutation" computes the impact, strength and power tests
+    # as permutation tests with n_permutations label shuffles (see
+    # permutation_test). With batch_alleles, test_allele_set runs them for
+    # all alleles at once after the evaluation; evaluate called on its own
+    # always returns complete records.
+    def __init__(self, *args, test_engine="scipy", n_permutations=10000, permutation_seed=0,
+                 batch_alleles=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        if test_engine == "permutation" and self.n_resamples > 1:
+            raise ValueError("test_engine='permutation' is not supported with n_resamples > 1")
+        self.test_engine = test_engine
+        self.n_permutations = n_permutations
+        self.permutation_seed = permutation_seed
+        self.batch_alleles = batch_alleles
+
+    def statistical_tests_medians(self, results, matrices):
+        wt_self_corr = corr.correlation_median_row(matrices["wt_wt"])
+        mut_self_corr = corr.correlation_median_row(matrices["mut_mut"])
+        cross_corr_row = numpy.median(matrices["wt_mut"], axis=0)
+        cross_corr_col = numpy.median(matrices["wt_mut"], axis=1)
+        wt_mut_cross = numpy.concatenate([cross_corr_row, cross_corr_col])
 
-    def statistical_tests_medians(self, results):
-        self.test_cols = ['wild_type', 'wt_samples', "mutant", 'mut_samples', 'impact_test', 'strength_test', 'directionality_test', 'power_test']
+        wt_signal = numpy.median(wt_self_corr)
+        mut_signal = numpy.median(mut_self_corr)
+        if self.test_engine == "permutation":
+            results["directionality_test"] = mut_signal > wt_signal
+            results["_medians"] = (wt_self_corr, mut_self_corr, wt_mut_cross)
+            if not (self.batch_alleles and self.defer_tests):
+                self.permutation_tests([results])
+            return results
 
-        wt_self_corr = corr.correlation_median_row(self.wt_wt)
-        mut_self_corr = corr.correlation_median_row(self.mut_mut)
-        cross_corr_row = numpy.median(self.wt_mut, axis=0)
-        cross_corr_col = numpy.median(self.wt_mut, axis=1)
-        wt_mut_cross = numpy.concatenate([cross_corr_row, cross_corr_col])
         impact_test = scipy.stats.kruskal(wt_self_corr, mut_self_corr, wt_mut_cross)
         results["impact_test"] = impact_test.pvalue
 
@@ -299,55 +888,71 @@ class Morphology_VIP_CNN_Features(Morphology_VIP):
         power_pvalue = wilcoxon_ranksums(wt_mut_cross, self.null_dist)
         results["power_test"] = power_pvalue
 
-        wt_signal = numpy.median(wt_self_corr)
-        mut_signal = numpy.median(mut_self_corr)
         results["directionality_test"] =  mut_signal > wt_signal
 
         return results
 
-    def adjust_pvalues(self, results, Q=0.05):
-        m = len(results)
-        test_fields = ["impact_test", "strength_test", "power_test"]
-        all_tests = []
-
-        ## Adjust p-values of all tests
-        for f in test_fields:        
-            sig, adj, a, b = stats_models.multipletests(results[f], method="fdr_bh")
-            results["is_sig_" + f] = sig
-            results["adjusted_" + f] = adj
-
-        # Run the Variant-Impact Phenotyping test
-        impact_test = results["is_sig_impact_test"]
-        strength_test = results["is_sig_strength_test"]
-        power_test = results["is_sig_power_test"]
-        direction_test = results["directionality_test"] > 0.0
-
-        results["prediction"] = "NI"
-        results.loc[impact_test & strength_test & direction_test , "prediction"] = "GOF"
-        results.loc[impact_test & strength_test & ~direction_test, "prediction"] = "LOF"
-        results.loc[impact_test & ~ strength_test, "prediction"] = "COF"
-        results.loc[~impact_test & power_test, "prediction"] = "NT"
+    # Permutation p-values of records with "_medians", grouped by sample sizes
+    def permutation_tests(self, records):
+        groups = {}
+        for record in records:
+            if "_medians" in record:
+                groups.setdefault(tuple(len(m) for m in record["_medians"]), []).append(record)
+        for group in groups.values():
+            wt_self_corr, mut_self_corr, wt_mut_cross = [numpy.stack(m) for m in zip(*[r.pop("_medians") for r in group])]
+            # One stream per allele and test
+            seeds = [allele_seed(self.permutation_seed, r["wild_type"], r["mutant"]).spawn(3) for r in group]
+            impact_seeds, strength_seeds, power_seeds = [list(s) for s in zip(*seeds)]
+            n = self.n_permutations
+            impact = permutation_test([wt_self_corr, mut_self_corr, wt_mut_cross], kruskal_rank_statistic, n, impact_seeds)
+            strength = permutation_test([wt_self_corr, mut_self_corr], ranksums_rank_statistic, n, strength_seeds)
+            power = permutation_test([wt_mut_cross, self.null_dist], ranksums_rank_statistic, n, power_seeds)
+            for record, impact_p, strength_p, power_p in zip(group, impact, strength, power):
+                record["impact_test"] = impact_p
+                record["strength_test"] = strength_p
+                record["power_test"] = power_p
+        return records
+
+    def complete_records(self, records):
+        return self.permutation_tests(records)
+
+    def statistical_tests_resampled(self, results, matrices):
+        alpha = self.stability_alpha
+        wt_self_corr = corr.correlation_median_row(matrices["wt_wt"])
+        mut_self_corr = corr.correlation_median_row(matrices["mut_mut"])
+        cross_corr_row = numpy.median(matrices["wt_mut"], axis=1)
+        cross_corr_col = numpy.median(matrices["wt_mut"], axis=2)
+        wt_mut_cross = numpy.concatenate([cross_corr_row, cross_corr_col], axis=1)
+
+        summarize_resamples(results, "impact_test", kruskal_batch(wt_self_corr, mut_self_corr, wt_mut_cross), alpha)
+        summarize_resamples(results, "strength_test", ranksums_batch(wt_self_corr, mut_self_corr), alpha)
+        summarize_resamples(results, "power_test", ranksums_batch(wt_mut_cross, self.null_dist), alpha)
+
+        # Direction agreed by the majority of resamples
+        wt_signal = numpy.median(wt_self_corr, axis=1)
+        mut_signal = numpy.median(mut_self_corr, axis=1)
+        results["directionality_test"] = numpy.mean(mut_signal > wt_signal) > 0.5
 
         return results
 
+    def adjust_pvalues(self, results, Q=0.05):
+        return adjust_cnn_feature_pvalues(results, Q=Q)
 
-    def update_index(self, results, field_name):
-        for idx, record in results.iterrows():
-            # search for wild_type
-            wt_idx = [x for x in range(len(self.index["children"])) if self.index["children"][x]["name"] == record["wild_type"] ]
-            if len(wt_idx) > 0:
-                wt_idx = wt_idx[0]
-                # search for mutant
-                mut_idx = [x for x in range(len(self.index["children"][wt_idx]["children"])) if self.index["children"][wt_idx]["children"][x]["name"] == record["mutant"]]
-                if len(mut_idx) > 0:
-                    mut_idx = mut_idx[0]
-                    # Add test results to the index:
-                    self.index["children"][wt_idx]["children"][mut_idx][field_name] = dict(record)
-                else:
-                    print(record["mutant"], "missing in index")
-                self.index["children"][wt_idx]["children"].sort(key=lambda r: r["name"])
-            else:
-                print(record["wild_type"], "missing in index")
-        self.index["children"].sort(key=lambda r: r["name"])
-         
 
+    # Add every row of results to the index entry of its allele, as field_name.
+    # The rows are matched to the entries with a left merge on (wild type,
+    # mutant); only the matched entries are then updated.
+    def update_index(self, results, field_name):
+        pairs = [(wild_type, mutant, entry) for wild_type, mutants in self.allele_index.items()
+                 for mutant, entry in mutants.items()]
+        entries = pandas.DataFrame(pairs, columns=["wild_type", "mutant", "_entry"])
+        matched = results[["wild_type", "mutant"]].merge(entries, how="left", on=["wild_type", "mutant"])
+        found = matched["_entry"].notna().to_numpy()
+        if not found.all():
+            has_wild_type = results["wild_type"].isin(self.allele_index).to_numpy()
+            for wild_type, mutant, known in zip(results["wild_type"][~found], results["mutant"][~found], has_wild_type[~found]):
+                print(mutant if known else wild_type, "missing in index")
+        for entry, record in zip(matched["_entry"][found], results[found].to_dict("records")):
+            # Add test results to the index:
+            entry[field_name] = record
+        self.index_sorted = True
@@ -0,0 +1,302 @@
+import os
+import hashlib
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Cosine nearest neighbors of single cells for the graph analysis of
+# notebook 5. The search runs on the CPU in blocks of queries: each block
+# is one matrix product against the normalized base set followed by a
+# top-k selection, so memory is O(block_size x N) per thread instead of
+# the N x N distance matrix.
+
+# Neighbor types, in the order of the concatenation CTL, WT, MUT. Missing
+# neighbors (index -1 from an approximate search) have no type.
+CTL, WT, MUT = 0, 1, 2
+MISSING = -1
+
+
+# Rows scaled to unit norm, as tf.nn.l2_normalize
+def normalize_rows(X, dtype=np.float32):
+    X = np.array(X, dtype=dtype)
+    norms = np.sqrt(np.maximum(np.einsum('ij,ij->i', X, X), 1e-12))
+    X /= norms[:, np.newaxis]
+    return X
+
+
+# Indices of the k largest values of every row of sims, sorted by
+# decreasing value and then by index, like repeated argmin on distances
+def top_k_rows(sims, k):
+    k = min(k, sims.shape[1])
+    part = np.argpartition(-sims, k - 1, axis=1)[:, 0:k]
+    values = np.take_along_axis(sims, part, axis=1)
+    order = np.lexsort((part, -values), axis=1)
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(values, order, axis=1)
+
+
+# k nearest base rows of every query row by cosine similarity.
+# queries and base must be normalized with normalize_rows. self_index gives,
+# for every query, a base row to exclude (e.g. the query itself), or -1.
+# Returns (queries x k) arrays of base indices and cosine similarities.
+def top_k_cosine(queries, base, k, block_size=1024, n_jobs=None, self_index=None):
+    n = queries.shape[0]
+    indices = np.empty((n, min(k, base.shape[0])), dtype=np.int64)
+    similarities = np.empty(indices.shape, dtype=base.dtype)
+
+    def search(start):
+        stop = min(start + block_size, n)
+        sims = np.dot(queries[start:stop], base.T)
+        if self_index is not None:
+            rows = np.arange(stop - start)
+            cols = np.asarray(self_index[start:stop])
+            valid = cols >= 0
+            sims[rows[valid], cols[valid]] = -np.inf
+        indices[start:stop], similarities[start:stop] = top_k_rows(sims, k)
+
+    n_jobs = n_jobs or os.cpu_count()
+    starts = range(0, n, block_size)
+    if n_jobs == 1:
+        for start in starts:
+            search(start)
+    else:
+        # Matrix products and argpartition release the GIL
+        with ThreadPoolExecutor(n_jobs) as pool:
+            list(pool.map(search, starts))
+    return indices, similarities
+
+
+# k nearest neighbors of every row of X among the other rows of X
+def knn_graph(X, k, block_size=1024, n_jobs=None, normalized=False):
+    X = X if normalized else normalize_rows(X)
+    return top_k_cosine(X, X, k, block_size=block_size, n_jobs=n_jobs, self_index=np.arange(X.shape[0]))
+
+
+# Type (CTL, WT or MUT) of every neighbor, given the sizes of the groups
+def neighbor_types(NN, n_ctl, n_wt):
+    types = np.full(NN.shape, MUT, dtype=np.int8)
+    types[NN < n_ctl + n_wt] = WT
+    types[NN < n_ctl] = CTL
+    types[NN < 0] = MISSING
+    return types
+
+
+# Composition of the neighborhoods of all cells, with the same results as
+# nearest_neighbors in notebook 5
+def neighborhood_scores(types, n_mut):
+    has_ctl = np.any(types == CTL, axis=1)
+    has_wt = np.any(types == WT, axis=1)
+    has_mut = np.any(types == MUT, axis=1)
+    A = np.sum(has_ctl & ~has_wt & ~has_mut)       # Controls
+    B = np.sum(~has_ctl & has_wt & ~has_mut)       # Wild types
+    C = np.sum(~has_ctl & ~has_wt & has_mut)       # Mutants
+    D = np.sum(has_ctl & has_wt & ~has_mut)        # Control or Wild type
+    E = np.sum(has_ctl & ~has_wt & has_mut)        # Control or Mutant
+    F = np.sum(~has_ctl & has_wt & has_mut)        # Wild type or Mutant
+    G = np.sum(has_ctl & has_wt & has_mut)         # All mixed
+
+    # Impact score: fraction of active mutant cells that are different from active wild type cells
+    with np.errstate(divide='ignore', invalid='ignore'):
+        impact_score = C/(C+F)
+
+    # Fraction of active mutant cells:
+    active_mutants = C/n_mut
+
+    results = {
+        "CTL": A, "WT": B, "MUT": C, "CTL-WT": D, "CTL-MUT": E, "WT-MUT": F, "ANY": G,
+        "impact_score": impact_score, "active_mutants": active_mutants
+    }
+
+    # Compatibility with previous analysis:
+    all_values = [B, C, F, A, D, E, G]
+
+    return results, all_values
+
+
+# Drop-in replacement of nearest_neighbors in notebook 5. With
+# return_neighbors=True the (cells x K) neighbor indices into the
+# concatenation of CTL, WT and MUT are returned as well.
+def nearest_neighbors(CTL, WT, MUT, K=5, block_size=1024, n_jobs=None, return_neighbors=False):
+    ALL = normalize_rows(np.concatenate([CTL, WT, MUT], axis=0))
+    NN, _ = knn_graph(ALL, K, block_size=block_size, n_jobs=n_jobs, normalized=True)
+    types = neighbor_types(NN, CTL.shape[0], WT.shape[0])
+    results, all_values = neighborhood_scores(types, MUT.shape[0])
+    if return_neighbors:
+        return results, all_values, NN
+    return results, all_values
+
+
+################################################################################
+## APPROXIMATE SEARCH
+################################################################################
+# For whole screens the control pool has millions of cells. IVFIndex
+# clusters the normalized cells with k-means and a query only scans the
+# cells of its n_probe closest clusters. The index is built once (over all
+# controls, or one index per plate group) and reused for every allele; the
+# wild type and mutant cells of an allele are searched exactly and merged
+# with the approximate neighbors from the index.
+
+# Best k of two sets of neighbors of the same queries
+def merge_neighbors(indices_a, sims_a, indices_b, sims_b, k):
+    indices = np.concatenate([indices_a, indices_b], axis=1)
+    sims = np.concatenate([sims_a, sims_b], axis=1)
+    pos, sims = top_k_rows(sims, k)
+    return np.take_along_axis(indices, pos, axis=1), sims
+
+
+# Fraction of the exact neighbors of every row that were found
+def recall_at_k(approx, exact):
+    found = [len(np.intersect1d(a, e)) for a, e in zip(approx, exact)]
+    return np.sum(found) / exact.size
+
+
+class IVFIndex(object):
+
+    def __init__(self, n_lists=None, n_probe=8, train_size=100000, seed=0, block_size=4096, n_jobs=None):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.train_size = train_size
+        self.seed = seed
+        self.block_size = block_size
+        self.n_jobs = n_jobs
+        self._neighbors = {}
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self.data.shape[0]
+
+    def fit(self, X, normalized=False):
+        from sklearn.cluster import MiniBatchKMeans
+        X = X if normalized else normalize_rows(X)
+        n_lists = self.n_lists or max(1, int(4 * np.sqrt(X.shape[0])))
+        rng = np.random.default_rng(self.seed)
+        train = X[rng.choice(X.shape[0], min(self.train_size, X.shape[0]), replace=False)]
+        kmeans = MiniBatchKMeans(n_clusters=min(n_lists, len(train)), random_state=self.seed, n_init=3)
+        kmeans.fit(train)
+        self.centroids = normalize_rows(kmeans.cluster_centers_, dtype=X.dtype)
+
+        # Cells are stored grouped by list, ids map them back to the rows of X
+        lists = np.empty(X.shape[0], dtype=np.int64)
+        for start in range(0, X.shape[0], self.block_size):
+            lists[start:start + self.block_size] = np.argmax(np.dot(X[start:start + self.block_size],
+                                                                    self.centroids.T), axis=1)
+        self.ids = np.argsort(lists, kind='stable')
+        self.positions = np.empty_like(self.ids)
+        self.positions[self.ids] = np.arange(len(self.ids))
+        self.data = X[self.ids]
+        self.offsets = np.searchsorted(lists[self.ids], np.arange(len(self.centroids) + 1))
+        self._neighbors = {}
+        return self
+
+    # Normalized vectors of rows of the fitted matrix
+    def vectors(self, rows):
+        return self.data[self.positions[rows]]
+
+    def _search_block(self, queries, k, query_ids, n_probe):
+        b = queries.shape[0]
+        probes, _ = top_k_rows(np.dot(queries, self.centroids.T), n_probe)
+        cand_idx = np.full((b, n_probe, k), -1, dtype=np.int64)
+        cand_sim = np.full((b, n_probe, k), -np.inf, dtype=self.data.dtype)
+        # Group the (query, probe) pairs by list
+        flat = probes.ravel()
+        order = np.argsort(flat, kind='stable')
+        bounds = np.searchsorted(flat[order], np.arange(len(self.centroids) + 1))
+        for l in np.unique(flat):
+            pairs = order[bounds[l]:bounds[l + 1]]
+            qrows, slots = pairs // n_probe, pairs % n_probe
+            start, stop = self.offsets[l], self.offsets[l + 1]
+            if stop == start:
+                continue
+            sims = np.dot(queries[qrows], self.data[start:stop].T)
+            if query_ids is not None:
+                own = self.positions[np.maximum(query_ids[qrows], 0)] - start
+                mask = (query_ids[qrows] >= 0) & (own >= 0) & (own < stop - start)
+                sims[np.flatnonzero(mask), own[mask]] = -np.inf
+            idx, sim = top_k_rows(sims, k)
+            cand_idx[qrows, slots, 0:idx.shape[1]] = self.ids[start + idx]
+            cand_sim[qrows, slots, 0:idx.shape[1]] = sim
+        pos, sims = top_k_rows(cand_sim.reshape(b, -1), k)
+        return np.take_along_axis(cand_idx.reshape(b, -1), pos, axis=1), sims
+
+    # Approximate k nearest indexed rows of every query. query_ids gives the
+    # row of the index of every query that is itself indexed (or -1), which
+    # is excluded from its neighbors. Missing neighbors have index -1.
+    def search(self, queries, k, query_ids=None, n_probe=None):
+        n = queries.shape[0]
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        indices = np.empty((n, k), dtype=np.int64)
+        similarities = np.empty((n, k), dtype=self.data.dtype)
+        query_ids = None if query_ids is None else np.asarray(query_ids)
+
+        def search(start):
+            stop = min(start + self.block_size, n)
+            ids = None if query_ids is None else query_ids[start:stop]
+            indices[start:stop], similarities[start:stop] = self._search_block(
+                queries[start:stop], k, ids, n_probe)
+
+        with ThreadPoolExecutor(self.n_jobs or os.cpu_count()) as pool:
+            list(pool.map(search, range(0, n, self.block_size)))
+        return indices, similarities
+
+    # Approximate k nearest indexed rows of indexed rows (excluding
+    # themselves). They are the same for every allele, so they are computed
+    # once per set of rows, k and n_probe and kept with the index.
+    def neighbors(self, rows, k, n_probe=None):
+        rows = np.asarray(rows, dtype=np.int64)
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        key = (k, n_probe, hashlib.sha1(rows.tobytes()).hexdigest())
+        with self._lock:
+            if key not in self._neighbors:
+                self._neighbors[key] = self.search(self.vectors(rows), k, query_ids=rows, n_probe=n_probe)
+            return self._neighbors[key]
+
+    # Exact neighbors among the indexed rows, for recall estimates
+    def exact_search(self, queries, k, query_ids=None):
+        self_index = None
+        if query_ids is not None:
+            query_ids = np.asarray(query_ids)
+            self_index = np.where(query_ids >= 0, self.positions[np.maximum(query_ids, 0)], -1)
+        idx, sims = top_k_cosine(queries, self.data, k, block_size=self.block_size,
+                                 n_jobs=self.n_jobs, self_index=self_index)
+        return self.ids[idx], sims
+
+
+# nearest_neighbors with the controls in an IVFIndex. The neighbors of every
+# cell are searched among all indexed controls (approximately) and the WT and
+# MUT cells (exactly). ctl_rows selects the indexed controls that are scored
+# as the CTL group (default: all of them). The approximate neighbors of the
+# controls are cached in the index, so for every allele only the WT and MUT
+# cells are searched in the index, and all cells against the WT and MUT
+# cells. results['recall'] is the recall of the K neighbors against exact
+# search, on recall_sample random cells.
+def ann_nearest_neighbors(index, WT, MUT, K=5, ctl_rows=None, recall_sample=1000, seed=0,
+                          block_size=1024, n_jobs=None, return_neighbors=False):
+    n_base = index.size
+    ctl_rows = np.arange(n_base) if ctl_rows is None else np.asarray(ctl_rows)
+    extra = normalize_rows(np.concatenate([WT, MUT], axis=0), dtype=index.data.dtype)
+    queries = np.concatenate([index.vectors(ctl_rows), extra], axis=0)
+    query_ids = np.concatenate([ctl_rows, n_base + np.arange(len(extra))])
+    extra_self = np.where(query_ids >= n_base, query_ids - n_base, -1)
+
+    ctl_idx, ctl_sim = index.neighbors(ctl_rows, K)
+    extra_idx, extra_sim = index.search(extra, K)
+    ann_idx = np.concatenate([ctl_idx, extra_idx])
+    ann_sim = np.concatenate([ctl_sim, extra_sim])
+    ext_idx, ext_sim = top_k_cosine(queries, extra, K, block_size=block_size, n_jobs=n_jobs,
+                                    self_index=extra_self)
+    NN, _ = merge_neighbors(ann_idx, ann_sim, ext_idx + n_base, ext_sim, K)
+
+    types = neighbor_types(NN, n_base, WT.shape[0])
+    results, all_values = neighborhood_scores(types, MUT.shape[0])
+
+    if recall_sample:
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(len(queries), min(recall_sample, len(queries)), replace=False)
+        ids = query_ids[sample]
+        exact_idx, exact_sim = index.exact_search(queries[sample], K, np.where(ids < n_base, ids, -1))
+        exact = merge_neighbors(exact_idx, exact_sim, ext_idx[sample] + n_base, ext_sim[sample], K)[0]
+        results["recall"] = recall_at_k(NN[sample], exact)
+
+    if return_neighbors:
+        return results, all_values, NN
+    return results, all_values
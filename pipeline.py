@@ -0,0 +1,459 @@
+'''
+Run the VIP analysis of notebooks 1 and 2 from the command line, with a cache of every stage.
+
+Stages of the Cell Painting branch: cp_metadata -> cp_profiles -> cp_zca ->
+cp_corr -> cp_null -> cp_mvip -> cp_adjust. Stages of the L1000 branch:
+l1k_matrix -> l1k_filter -> l1k_null -> l1k_mvip -> l1k_adjust. The output of a stage is
+stored in <cache>/<stage>/<key>, where the key is a hash of the parameters
+of the stage, its input files (their content, or their size and
+modification time for files larger than HASH_LIMIT), the source of the
+stage and of the project modules it uses (e.g. mvip.py, correlations.py)
+and the keys of the stages it depends on. Stages whose key
+already has an output are not run again, so changing e.g. the FDR threshold
+Q only reruns the adjust stages. The two branches run concurrently.
+
+    python pipeline.py --output outputs/
+    python pipeline.py --set cp_mvip.test_engine=permutation --set cp_zca.regularization=0.1
+    python pipeline.py --branch cp --sweep cp_adjust.Q=0.01,0.05,0.1
+'''
+import argparse
+import copy
+import functools
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import pandas as pd
+
+import correlations as corr
+import correlation_store
+import mvip
+import profiles
+import zca
+from zca import ZCA
+
+# Parameters of every stage. Values in PATHS are input files: the content of
+# files up to HASH_LIMIT bytes is part of the key, larger files (e.g. the
+# profiles) are only identified by their path, size and modification time.
+DEFAULTS = {
+    'cp_metadata': {'barcode_platemap': 'inputs/metadata/cytodata/barcode_platemap.csv',
+                    'platemaps': ['inputs/metadata/cytodata/platemap/DOC45.46.47.48.txt',
+                                  'inputs/metadata/cytodata/platemap/DOC49.50.51.52.txt'],
+                    'control_def': 'EMPTY'},
+    'cp_profiles': {'profiles': 'efn_pretrained_profiles.parquet'},
+    'cp_zca': {'regularization': 1e-2},
+    'cp_corr': {},
+    'cp_null': {'sample_size': 8, 'repeats': 1000, 'seed': 0},
+    'cp_mvip': {'treatment_samples': 8, 'control_samples': 20, 'seed': 0, 'n_jobs': 1,
+                'create_images': False, 'test_engine': 'scipy', 'n_permutations': 10000},
+    'cp_adjust': {'Q': 0.05},
+    'l1k_matrix': {'l1000': 'l1000.parquet', 'dtype': 'float32'},
+    'l1k_filter': {'exclude': 'TP53'},
+    'l1k_null': {'sample_size': 8, 'repeats': 1000, 'seed': 0},
+    'l1k_mvip': {'treatments': 'inputs/metadata/l1k/treatments.csv', 'treatment_samples': 8,
+                 'control_samples': 20, 'seed': 0, 'n_jobs': 1, 'create_images': False,
+                 'test_engine': 'scipy', 'n_permutations': 10000},
+    'l1k_adjust': {'Q': 0.05},
+}
+HASH_LIMIT = 2**26
+PATHS = {'barcode_platemap', 'platemaps', 'profiles', 'l1000', 'treatments'}
+# Parameters that do not change the output (test_allele_set gives the same
+# results with any number of workers)
+UNKEYED = {'n_jobs'}
+
+BRANCHES = {
+    'cp': ['cp_metadata', 'cp_profiles', 'cp_zca', 'cp_corr', 'cp_null', 'cp_mvip', 'cp_adjust'],
+    'l1k': ['l1k_matrix', 'l1k_filter', 'l1k_null', 'l1k_mvip', 'l1k_adjust'],
+}
+
+# Final results, copied to the output directory with the names used by the notebooks
+RESULTS = {'cp_adjust': 'benchmark_results.csv', 'l1k_adjust': 'benchmark_results_expression.csv'}
+
+
+## STAGES
+## Every stage reads the outputs of its dependencies from their directories
+## and writes its files to out_dir.
+
+# Wild type of a gene out of the suffixes of its alleles; a closed WT is
+# preferred if there are several (choose_wild_type of notebook 2)
+def choose_wild_type(options):
+    wtypes = [opt for opt in options if opt and 'WT.' in opt]
+    if not wtypes:
+        return None
+    if len(wtypes) == 1:
+        return wtypes[0]
+    return next(filter(lambda x: '.c' in x, wtypes))
+
+
+# Alleles kept by notebook 2 (get_allele_stats): mutants whose gene has a
+# wild type, and the wild types that have at least one mutant
+def paired_alleles(s):
+    s = s[s != 'EMPTY']
+    alleles = s.str.split('_', expand=True, n=1)
+    alleles.columns = ['gene', 'suffix']
+    wild_type_map = alleles.groupby('gene')['suffix'].unique().apply(choose_wild_type)
+    wild_type_map = wild_type_map.index.astype(str) + '_' + wild_type_map
+    wild_type = alleles.gene.map(wild_type_map)
+    is_mutant = ~s.str.contains('WT')
+    wt_with_mut = wild_type[is_mutant].dropna().drop_duplicates()
+    mut_with_wt = s[~wild_type.isna() & is_mutant].drop_duplicates()
+    return pd.concat([wt_with_mut, mut_with_wt])
+
+
+# Plate maps of the wells that passed QC, with the controls of control_def
+# and the alleles of paired_alleles, as in notebook 2
+def cp_metadata(params, deps, out_dir):
+    platemaps = pd.read_csv(params['barcode_platemap'])
+    pmaps = pd.concat([pd.read_csv(f, sep='\t') for f in params['platemaps']])
+    pmaps = pmaps[pmaps.qc_status]
+    metadata = pmaps.merge(platemaps, how='inner', left_on='VirusPlateName', right_on='Plate_Map_Name')
+    morphology = metadata[['Assay_Plate_Barcode', 'well_position', 'broad_sample', 'pert_type', 'x_mutation_status']].copy()
+    morphology.columns = ['Metadata_Plate', 'Metadata_Well', 'Metadata_broad_sample', 'pert_type', 'x_mutation_status']
+    control_def = params['control_def']
+    if control_def == 'EMPTY':
+        morphology = morphology[morphology.pert_type != 'ctl_vector'].copy()
+        morphology['Metadata_broad_sample_type'] = morphology.pert_type.apply(lambda x: 'control' if x == 'EMPTY' else 'trt')
+    elif control_def == 'NOT_TREATMENT':
+        morphology['Metadata_broad_sample_type'] = morphology.pert_type.apply(lambda x: 'control' if x != 'trt_oe' else 'trt')
+    elif control_def == 'CTL_VECTOR':
+        morphology = morphology[morphology.pert_type != 'EMPTY'].copy()
+        morphology['Metadata_broad_sample_type'] = morphology.pert_type.apply(lambda x: 'control' if x == 'ctl_vector' else 'trt')
+    else:
+        raise ValueError(f'Unknown control_def {control_def}')
+    # Keep only MUT with WT and WT with MUT
+    alleles = paired_alleles(morphology.x_mutation_status)
+    morphology = morphology[morphology.x_mutation_status.isin(alleles) |
+                            (morphology.x_mutation_status == 'EMPTY')]
+    morphology.to_parquet(os.path.join(out_dir, 'metadata.parquet'))
+
+
+def cp_profiles(params, deps, out_dir):
+    metadata = pd.read_parquet(os.path.join(deps['cp_metadata'], 'metadata.parquet'))
+    features, meta = profiles.load_profiles(params['profiles'], metadata, dtype=np.float64)
+    np.save(os.path.join(out_dir, 'features.npy'), features)
+    meta.to_parquet(os.path.join(out_dir, 'metadata.parquet'))
+
+
+def cp_zca(params, deps, out_dir):
+    features = np.load(os.path.join(deps['cp_profiles'], 'features.npy'))
+    metadata = pd.read_parquet(os.path.join(deps['cp_profiles'], 'metadata.parquet'))
+    controls = (metadata.Metadata_broad_sample_type == 'control').to_numpy()
+    spherer = ZCA(regularization=params['regularization']).fit(features[controls])
+    spherer.save(os.path.join(out_dir, 'zca.npz'))
+    np.save(os.path.join(out_dir, 'features.npy'), spherer.transform(features, out=features))
+
+
+def cp_corr(params, deps, out_dir):
+    features = np.load(os.path.join(deps['cp_zca'], 'features.npy'))
+    np.save(os.path.join(out_dir, 'corr_matrix.npy'), corr.correlation_matrix(features, 0))
+
+
+def null_stage(metadata, corr_matrix, treated, params, out_dir):
+    rng = np.random.default_rng(params['seed'])
+    null = corr.null_distribution(metadata[treated].index, corr_matrix, params['sample_size'],
+                                  repeats=params['repeats'], rng=rng)
+    np.save(os.path.join(out_dir, 'null.npy'), null)
+
+
+def cp_null(params, deps, out_dir):
+    metadata = pd.read_parquet(os.path.join(deps['cp_profiles'], 'metadata.parquet'))
+    corr_matrix = np.load(os.path.join(deps['cp_corr'], 'corr_matrix.npy'), mmap_mode='r')
+    null_stage(metadata, corr_matrix, metadata.Metadata_broad_sample_type == 'trt', params, out_dir)
+
+
+def mvip_stage(vip, alleles, null, params, out_dir):
+    images_dir = os.path.join(out_dir, 'images')
+    results = vip.test_allele_set(alleles, create_images=params['create_images'], null_distribution=null,
+                                  images_dir=images_dir, n_jobs=params['n_jobs'], seed=params['seed'])
+    results.to_csv(os.path.join(out_dir, 'results.csv'), index=False)
+
+
+def mvip_options(params):
+    return {'treatment_samples': params['treatment_samples'], 'control_samples': params['control_samples'],
+            'test_engine': params['test_engine'], 'n_permutations': params['n_permutations']}
+
+
+def cp_mvip(params, deps, out_dir):
+    metadata = pd.read_parquet(os.path.join(deps['cp_profiles'], 'metadata.parquet'))
+    corr_matrix = np.load(os.path.join(deps['cp_corr'], 'corr_matrix.npy'), mmap_mode='r')
+    null = np.load(os.path.join(deps['cp_null'], 'null.npy'))[0:1000]
+    alleles = [a for a in metadata['x_mutation_status'].unique() if a.find('WT') == -1]
+    vip = mvip.Morphology_VIP_CNN_Features(metadata, corr_matrix, perturbation_field='x_mutation_status',
+                                           **mvip_options(params))
+    mvip_stage(vip, alleles, null, params, out_dir)
+
+
+def adjust_stage(params, results_dir, out_dir):
+    results = pd.read_csv(os.path.join(results_dir, 'results.csv'))
+    mvip.adjust_cnn_feature_pvalues(results, Q=params['Q']).to_csv(os.path.join(out_dir, 'results.csv'), index=False)
+
+
+def cp_adjust(params, deps, out_dir):
+    adjust_stage(params, deps['cp_mvip'], out_dir)
+
+
+def l1k_matrix(params, deps, out_dir):
+    correlation_store.convert_matrix_columns(params['l1000'], os.path.join(out_dir, 'corr_matrix'),
+                                             os.path.join(out_dir, 'metadata.parquet'),
+                                             dtype=np.dtype(params['dtype']))
+
+
+# Metadata of notebook 1 without the excluded alleles, renumbered from 0,
+# and the rows of the packed matrix that are kept
+def l1k_filter(params, deps, out_dir):
+    expression = pd.read_parquet(os.path.join(deps['l1k_matrix'], 'metadata.parquet'))
+    keep = ~expression.x_mutation_status.str.contains(params['exclude'])
+    expression = expression[keep].copy()
+    expression['original_index'] = expression.index
+    expression.index = range(len(expression))
+    expression.to_parquet(os.path.join(out_dir, 'metadata.parquet'))
+    np.save(os.path.join(out_dir, 'rows.npy'), np.flatnonzero(keep.to_numpy()))
+
+
+def l1k_inputs(deps):
+    expression = pd.read_parquet(os.path.join(deps['l1k_filter'], 'metadata.parquet'))
+    corr_matrix = correlation_store.PackedCorrelationMatrix(os.path.join(deps['l1k_matrix'], 'corr_matrix'))
+    return expression, corr_matrix.take(np.load(os.path.join(deps['l1k_filter'], 'rows.npy')))
+
+
+def l1k_null(params, deps, out_dir):
+    expression, corr_matrix = l1k_inputs(deps)
+    null_stage(expression, corr_matrix, expression.pert_type.str.find('ctl') == -1, params, out_dir)
+
+
+def l1k_mvip(params, deps, out_dir):
+    expression, corr_matrix = l1k_inputs(deps)
+    null = np.load(os.path.join(deps['l1k_null'], 'null.npy'))
+    null = null[null != 0][0:1000]
+    treatments = pd.read_csv(params['treatments'])
+    exprs = pd.merge(treatments, expression, how='inner', left_on='pert_iname', right_on='pert_iname')
+    alleles = [a for a in exprs['x_mutation_status'].unique() if a.find('WT') == -1]
+    vip = mvip.Morphology_VIP_CNN_Features(expression, corr_matrix, controls_value='EMPTY',
+                                           perturbation_field='x_mutation_status', controls_field='pert_iname',
+                                           plate_field='mfc_plate_name', **mvip_options(params))
+    mvip_stage(vip, alleles, null, params, out_dir)
+
+
+def l1k_adjust(params, deps, out_dir):
+    adjust_stage(params, deps['l1k_mvip'], out_dir)
+
+
+# Every stage: function, dependencies, and the code it runs besides its own
+# function (helpers and project modules), whose source is part of the key
+STAGES = {
+    'cp_metadata': (cp_metadata, [], [choose_wild_type, paired_alleles]),
+    'cp_profiles': (cp_profiles, ['cp_metadata'], [profiles]),
+    'cp_zca': (cp_zca, ['cp_profiles'], [zca]),
+    'cp_corr': (cp_corr, ['cp_zca'], [corr]),
+    'cp_null': (cp_null, ['cp_profiles', 'cp_corr'], [null_stage, corr]),
+    'cp_mvip': (cp_mvip, ['cp_profiles', 'cp_corr', 'cp_null'],
+                [mvip_stage, mvip_options, mvip, mvip.figures, corr]),
+    'cp_adjust': (cp_adjust, ['cp_mvip'], [adjust_stage, mvip]),
+    'l1k_matrix': (l1k_matrix, [], [correlation_store]),
+    'l1k_filter': (l1k_filter, ['l1k_matrix'], []),
+    'l1k_null': (l1k_null, ['l1k_matrix', 'l1k_filter'], [l1k_inputs, null_stage, corr, correlation_store]),
+    'l1k_mvip': (l1k_mvip, ['l1k_matrix', 'l1k_filter', 'l1k_null'],
+                 [l1k_inputs, mvip_stage, mvip_options, mvip, mvip.figures, corr, correlation_store]),
+    'l1k_adjust': (l1k_adjust, ['l1k_mvip'], [adjust_stage, mvip]),
+}
+
+
+## CACHE
+
+@functools.lru_cache(maxsize=None)
+def content_hash(path, size, mtime):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Hash of the content of an input file up to HASH_LIMIT bytes, or its path,
+# size and modification time (also for every file of a directory of parquet
+# files)
+def file_signature(path):
+    if path is None:
+        return None
+    if isinstance(path, (list, tuple)):
+        return [file_signature(p) for p in path]
+    if os.path.isdir(path):
+        return sorted([os.path.relpath(os.path.join(root, f), path), file_signature(os.path.join(root, f))]
+                      for root, _, files in os.walk(path) for f in files)
+    st = os.stat(path)
+    if st.st_size <= HASH_LIMIT:
+        return content_hash(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+
+@functools.lru_cache(maxsize=None)
+def code_hash(obj):
+    return hashlib.sha1(inspect.getsource(obj).encode()).hexdigest()
+
+
+def stage_key(name, params, dep_keys):
+    func, _, code = STAGES[name]
+    description = {
+        'stage': name,
+        'code': [code_hash(func)] + [code_hash(obj) for obj in code],
+        'params': {k: v for k, v in params.items() if k not in UNKEYED},
+        'files': {k: file_signature(v) for k, v in params.items() if k in PATHS},
+        'deps': dep_keys,
+    }
+    return hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Pipeline(object):
+
+    # params: {stage: {param: value}} merged over DEFAULTS
+    def __init__(self, cache_dir, params=None, workers=2, force=()):
+        self.cache_dir = cache_dir
+        self.params = copy.deepcopy(DEFAULTS)
+        for stage, values in (params or {}).items():
+            self.params[stage].update(values)
+        self.workers = workers
+        self.force = set(force)
+        self.keys = {}
+
+    def key(self, name):
+        if name not in self.keys:
+            deps = {d: self.key(d) for d in STAGES[name][1]}
+            self.keys[name] = stage_key(name, self.params[name], deps)
+        return self.keys[name]
+
+    def stage_dir(self, name):
+        return os.path.join(self.cache_dir, name, self.key(name)[0:16])
+
+    def is_cached(self, name):
+        return name not in self.force and os.path.exists(os.path.join(self.stage_dir(name), 'stage.json'))
+
+    # Run a stage into a temporary directory, renamed to its key when
+    # complete, so that failed or interrupted stages leave no output
+    def run_stage(self, name):
+        func, deps, _ = STAGES[name]
+        final = self.stage_dir(name)
+        os.makedirs(os.path.dirname(final), exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=f'.{os.path.basename(final)}-', dir=os.path.dirname(final))
+        try:
+            start = time.perf_counter()
+            func(self.params[name], {d: self.stage_dir(d) for d in deps}, tmp)
+            info = {'stage': name, 'key': self.key(name), 'params': self.params[name],
+                    'deps': {d: self.key(d) for d in deps}, 'seconds': time.perf_counter() - start}
+            with open(os.path.join(tmp, 'stage.json'), 'w') as f:
+                json.dump(info, f, indent=2, default=str)
+            if os.path.exists(final):
+                shutil.rmtree(final)
+            os.replace(tmp, final)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        print(f'{name:<12} done in {info["seconds"]:.1f} s -> {final}')
+        return final
+
+    # Run the targets and their dependencies. Stages run as soon as their
+    # dependencies are done, on a pool of threads, so independent branches
+    # run concurrently.
+    def run(self, targets):
+        needed = []
+        def visit(name):
+            if name not in needed:
+                for d in STAGES[name][1]:
+                    visit(d)
+                needed.append(name)
+        for t in targets:
+            visit(t)
+
+        done = set()
+        for name in needed:
+            if self.is_cached(name):
+                print(f'{name:<12} cached -> {self.stage_dir(name)}')
+                done.add(name)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while len(done) < len(needed):
+                for name in needed:
+                    if name not in done and name not in running.values() and \
+                            all(d in done for d in STAGES[name][1]):
+                        running[pool.submit(self.run_stage, name)] = name
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    future.result()
+                    done.add(running.pop(future))
+        return {name: self.stage_dir(name) for name in targets}
+
+
+## COMMAND LINE
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+# 'stage.param=value' -> (stage, param, value)
+def parse_assignment(text):
+    name, value = text.split('=', 1)
+    stage, param = name.split('.', 1)
+    if stage not in DEFAULTS or param not in DEFAULTS[stage]:
+        raise argparse.ArgumentTypeError(f'Unknown parameter {name}')
+    return stage, param, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the VIP analysis with a cache of every stage')
+    parser.add_argument('--branch', choices=['all'] + list(BRANCHES), default='all')
+    parser.add_argument('--target', action='append', choices=list(STAGES),
+                        help='stage to compute (default: the last stage of the branches)')
+    parser.add_argument('--set', action='append', default=[], type=parse_assignment, metavar='STAGE.PARAM=VALUE',
+                        help='parameter value, e.g. cp_zca.regularization=0.1 (JSON values are parsed)')
+    parser.add_argument('--sweep', action='append', default=[], type=parse_assignment,
+                        metavar='STAGE.PARAM=V1,V2', help='run the pipeline for every combination of values')
+    parser.add_argument('--config', help='JSON file with {stage: {param: value}}')
+    parser.add_argument('--cache', default='outputs/cache', help='cache directory')
+    parser.add_argument('--output', default='outputs', help='directory of the final results')
+    parser.add_argument('--workers', type=int, default=2, help='stages run at the same time')
+    parser.add_argument('--force', action='append', default=[], choices=list(STAGES), help='rerun this stage')
+    args = parser.parse_args()
+
+    params = {}
+    if args.config:
+        with open(args.config) as f:
+            params = json.load(f)
+    for stage, param, value in args.set:
+        params.setdefault(stage, {})[param] = parse_value(value)
+    branches = list(BRANCHES) if args.branch == 'all' else [args.branch]
+    targets = args.target or [BRANCHES[b][-1] for b in branches]
+
+    sweep = [(stage, param, [parse_value(v) for v in values.split(',')]) for stage, param, values in args.sweep]
+    runs = []
+    for values in itertools.product(*[s[2] for s in sweep]):
+        run_params = copy.deepcopy(params)
+        for (stage, param, _), value in zip(sweep, values):
+            run_params.setdefault(stage, {})[param] = value
+        if sweep:
+            print('Parameters:', ', '.join(f'{s}.{p}={v}' for (s, p, _), v in zip(sweep, values)))
+        outputs = Pipeline(args.cache, run_params, workers=args.workers, force=args.force).run(targets)
+        runs.append(({f'{s}.{p}': v for (s, p, _), v in zip(sweep, values)}, outputs))
+
+    os.makedirs(args.output, exist_ok=True)
+    if not sweep:
+        for name, path in runs[0][1].items():
+            if name in RESULTS:
+                shutil.copyfile(os.path.join(path, 'results.csv'), os.path.join(args.output, RESULTS[name]))
+    else:
+        # One row per combination, with the directory of every target
+        summary = pd.DataFrame([dict(values, **outputs) for values, outputs in runs])
+        summary.to_csv(os.path.join(args.output, 'sweep.csv'), index=False)
+        print(summary.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# Load well profiles (the parquet output of utils/create_profiles.py, a
+# single file or a directory of per-plate files) for the wells of a metadata
+# frame. Only the wells listed in the metadata are read, and features are
+# converted to a float32 matrix while reading, without building a pandas
+# frame of the full table.
+
+KEY_COLS = ['Metadata_Plate', 'Metadata_Well']
+
+
+# Dataset filter that keeps the rows whose key values appear in metadata.
+# Values are cast to the types stored in the dataset.
+def key_filter(dataset, metadata, key_cols=KEY_COLS):
+    expr = None
+    for col in key_cols:
+        values = pa.array(metadata[col].drop_duplicates().tolist())
+        values = values.cast(dataset.schema.field(col).type)
+        col_expr = ds.field(col).isin(values)
+        expr = col_expr if expr is None else expr & col_expr
+    return expr
+
+
+def feature_columns(dataset, key_cols=KEY_COLS):
+    return [f.name for f in dataset.schema if f.name not in key_cols and pa.types.is_floating(f.type)]
+
+
+# Returns a (wells x features) C-contiguous matrix and the metadata of its
+# rows, sorted by key_cols. This is the same result as sorting and merging
+# the metadata with the full profiles table on key_cols, followed by
+# select_dtypes(include=["float64"]).
+def load_profiles(source, metadata, key_cols=KEY_COLS, dtype=np.float32, batch_size=1024):
+    dataset = ds.dataset(source, format='parquet')
+    feature_cols = feature_columns(dataset, key_cols)
+    expr = key_filter(dataset, metadata, key_cols)
+
+    # First pass: only the key columns, to know which wells are present
+    keys = dataset.to_table(columns=key_cols, filter=expr).to_pandas()
+    if keys.duplicated().any():
+        raise ValueError(f'{source} has more than one profile for some wells')
+    meta = metadata.copy()
+    for col in key_cols:
+        # e.g. plate barcodes read as integers from a csv and stored as strings
+        meta[col] = meta[col].astype(str if keys[col].dtype == object else keys[col].dtype)
+    meta = pd.merge(keys.sort_values(by=key_cols), meta, on=key_cols)
+    meta.reset_index(drop=True, inplace=True)
+    positions = pd.MultiIndex.from_frame(meta[key_cols])
+    if not positions.is_unique:
+        raise ValueError('metadata has more than one row for some wells')
+
+    # Second pass: features, written in place into the preallocated matrix
+    features = np.empty((len(meta), len(feature_cols)), dtype=dtype)
+    scanner = dataset.scanner(columns=key_cols + feature_cols, filter=expr, batch_size=batch_size)
+    for batch in scanner.to_batches():
+        if batch.num_rows == 0:
+            continue
+        batch_keys = pd.MultiIndex.from_arrays([batch.column(i).to_numpy(zero_copy_only=False)
+                                                for i in range(len(key_cols))])
+        rows = positions.get_indexer(batch_keys)
+        # Wells that passed the filter on each column but not as a pair
+        keep = rows >= 0
+        block = np.empty((batch.num_rows, len(feature_cols)), dtype=dtype)
+        for j in range(len(feature_cols)):
+            block[:, j] = batch.column(len(key_cols) + j).to_numpy(zero_copy_only=False)
+        features[rows[keep]] = block[keep]
+    return features, meta
@@ -0,0 +1,144 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+from tqdm.auto import tqdm
+
+# Consolidated store of DeepProfiler single-cell features.
+# All cells are written once to a float32 binary file, grouped by allele, so
+# that the cells of an allele are a contiguous block that can be read from a
+# memory map. The store directory contains:
+#  - features.bin: (cells x features) float32 matrix in C order
+#  - cells.parquet: plate, well, site, cell number and allele of every row
+#  - sites.parquet: feature file of every site, used to build image names
+#  - alleles.parquet: first and last row of every allele
+#  - store.json: shape and dtype of the matrix, written when the store is complete
+
+SITE_COLS = ['Metadata_Plate', 'Metadata_Well', 'Metadata_Site']
+
+
+# Features of a site without the cells that have NaN values, and the cell
+# numbers that were kept
+def read_site_cells(filename):
+    with np.load(filename) as data:
+        features = data['features']
+    keep = np.flatnonzero(~np.isnan(np.sum(features, axis=1)))
+    return np.ascontiguousarray(features[keep], dtype=np.float32), keep
+
+
+# Build a store from a frame with one row per site, with the SITE_COLS, a
+# 'filename' column with the .npz feature file and allele_field (e.g. the
+# rdf frame of notebook 4). Sites are decompressed by a pool of workers.
+def build_store(sites, output_dir, allele_field='Treatment', workers=None):
+    os.makedirs(output_dir, exist_ok=True)
+    sites = sites.dropna(subset=[allele_field])
+    # Stable sort: cells of an allele keep the order of the sites frame
+    sites = sites.sort_values(by=allele_field, kind='stable').reset_index(drop=True)
+    site_table = sites[SITE_COLS + ['filename']]
+    site_table.to_parquet(os.path.join(output_dir, 'sites.parquet'))
+
+    done = os.path.join(output_dir, 'store.json')
+    if os.path.exists(done):
+        os.remove(done)
+    cells = []
+    num_feats = None
+    with open(os.path.join(output_dir, 'features.bin'), 'wb') as out, Pool(workers) as pool:
+        reader = pool.imap(read_site_cells, sites['filename'], chunksize=4)
+        for site_id, (features, cell_numbers) in enumerate(tqdm(reader, total=len(sites))):
+            if num_feats is None:
+                num_feats = features.shape[1]
+            elif features.shape[1] != num_feats:
+                raise ValueError(f'{sites.loc[site_id, "filename"]} has {features.shape[1]} features, '
+                                 f'expected {num_feats}')
+            out.write(features.tobytes())
+            cells.append((np.full(len(cell_numbers), site_id), cell_numbers))
+
+    site_ids = np.concatenate([c[0] for c in cells]) if cells else np.zeros(0, dtype=int)
+    cell_table = sites.loc[site_ids, SITE_COLS + [allele_field]].reset_index(drop=True)
+    cell_table.columns = SITE_COLS + ['allele']
+    cell_table['Metadata_Cell'] = np.concatenate([c[1] for c in cells]) if cells else site_ids
+    cell_table['site'] = site_ids
+    cell_table['allele'] = cell_table['allele'].astype('category')
+    cell_table.to_parquet(os.path.join(output_dir, 'cells.parquet'))
+
+    # Rows are sorted by allele, so every allele is one range of rows
+    alleles = cell_table.groupby('allele', observed=True, sort=True).indices
+    allele_table = pd.DataFrame([(a, rows[0], rows[-1] + 1) for a, rows in alleles.items()],
+                                columns=['allele', 'start', 'stop'])
+    allele_table.to_parquet(os.path.join(output_dir, 'alleles.parquet'))
+
+    with open(done, 'w') as f:
+        json.dump({'shape': [len(cell_table), num_feats or 0], 'dtype': 'float32'}, f)
+    return SingleCellStore(output_dir)
+
+
+class SingleCellStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'store.json')) as f:
+            info = json.load(f)
+        shape = tuple(info['shape'])
+        if shape[0] > 0:
+            self.features = np.memmap(os.path.join(path, 'features.bin'), dtype=info['dtype'],
+                                      mode='r', shape=shape)
+        else:
+            self.features = np.zeros(shape, dtype=info['dtype'])
+        self.cells = pd.read_parquet(os.path.join(path, 'cells.parquet'))
+        self.sites = pd.read_parquet(os.path.join(path, 'sites.parquet'))
+        alleles = pd.read_parquet(os.path.join(path, 'alleles.parquet'))
+        self.ranges = {a: (start, stop) for a, start, stop in alleles.itertuples(index=False)}
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    @property
+    def alleles(self):
+        return list(self.ranges)
+
+    def allele_slice(self, allele):
+        start, stop = self.ranges[allele]
+        return slice(start, stop)
+
+    # Read-only view of the cells of one allele
+    def get(self, allele):
+        return self.features[self.allele_slice(allele)]
+
+    # Rows of the alleles whose name contains pattern (a regular expression
+    # by default, as the str.contains filter of notebook 4). Cells are
+    # grouped by allele, in alphabetical order of the alleles.
+    def rows(self, pattern, regex=True):
+        names = pd.Series(self.alleles, dtype=object)
+        matches = names[names.str.contains(pattern, regex=regex)]
+        ranges = [np.arange(*self.ranges[a]) for a in matches]
+        return np.concatenate(ranges) if ranges else np.zeros(0, dtype=np.int64)
+
+    # Image name of every row, as '<site file without .npz>/<cell>.jpg'
+    def image_names(self, rows):
+        cells = self.cells.iloc[rows]
+        prefixes = self.sites['filename'].str.replace('.npz', '/', regex=False).to_numpy()
+        return [prefixes[s] + str(c) + '.jpg' for s, c in zip(cells['site'], cells['Metadata_Cell'])]
+
+    # Replacement of load_single_cells in notebook 4: features and image
+    # names of the cells of the matching alleles, or (None, None)
+    def select(self, pattern, regex=True):
+        rows = self.rows(pattern, regex=regex)
+        if len(rows) == 0:
+            return None, None
+        # Contiguous rows are copied as one slice
+        if rows[-1] - rows[0] + 1 == len(rows):
+            features = np.array(self.features[rows[0]:rows[-1] + 1])
+        else:
+            features = self.features[rows]
+        return features, self.image_names(rows)
+
+    # Chunks of rows, e.g. to fit a ZCA normalizer with fit_stream
+    def iter_chunks(self, rows=None, chunk_size=65536):
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        for start in range(0, len(rows), chunk_size):
+            block = rows[start:start + chunk_size]
+            if len(block) and block[-1] - block[0] + 1 == len(block):
+                yield np.array(self.features[block[0]:block[-1] + 1])
+            else:
+                yield self.features[block]
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The modules of the analysis are not a package: make them, the scripts in
+# utils/ and the synthetic screens of the benchmarks importable
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in [ROOT, os.path.join(ROOT, 'utils'), os.path.join(ROOT, 'benchmarks')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
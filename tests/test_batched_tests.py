@@ -0,0 +1,66 @@
+import numpy as np
+import scipy.stats
+import pytest
+
+import mvip
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+def test_ranksums_batch_matches_scipy(rng):
+    a = rng.normal(size=(50, 8))
+    b = rng.normal(0.3, 1, size=(50, 12))
+    expected = [scipy.stats.ranksums(x, y).pvalue for x, y in zip(a, b)]
+    np.testing.assert_allclose(mvip.ranksums_batch(a, b), expected, rtol=1e-10)
+
+
+def test_ranksums_batch_shared_sample(rng):
+    a = rng.normal(size=(20, 16))
+    null = rng.normal(size=300)
+    expected = [scipy.stats.ranksums(x, null).pvalue for x in a]
+    np.testing.assert_allclose(mvip.ranksums_batch(a, null), expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize('decimals', [None, 1])
+def test_kruskal_batch_matches_scipy(rng, decimals):
+    samples = [rng.normal(size=(40, 8)), rng.normal(0.2, 1, size=(40, 8)), rng.normal(size=(40, 16))]
+    if decimals is not None:
+        # Ties use the tie correction
+        samples = [np.round(x, decimals) for x in samples]
+    expected = [scipy.stats.kruskal(*rows).pvalue for rows in zip(*samples)]
+    np.testing.assert_allclose(mvip.kruskal_batch(*samples), expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize('n, controls', [(4, 10), (8, 30), (60, 20)])
+def test_wilcoxon_test_batch_matches_scipy(rng, n, controls):
+    self_corr = rng.normal(size=(30, n, n))
+    self_corr = (self_corr + self_corr.transpose(0, 2, 1)) / 2
+    control_corr = rng.normal(0.2, 1, size=(30, n, controls))
+    expected = [mvip.wilcoxon_test(a, b) for a, b in zip(self_corr, control_corr)]
+    np.testing.assert_allclose(mvip.wilcoxon_test_batch(self_corr, control_corr), expected, rtol=1e-12)
+
+
+def test_wilcoxon_test_batch_with_ties(rng):
+    self_corr = np.round(rng.normal(size=(30, 6, 6)), 1)
+    control_corr = np.round(rng.normal(size=(30, 6, 7)), 1)
+    expected = [mvip.wilcoxon_test(a, b) for a, b in zip(self_corr, control_corr)]
+    np.testing.assert_allclose(mvip.wilcoxon_test_batch(self_corr, control_corr), expected, rtol=1e-12)
+
+
+def test_permutation_test_approaches_scipy(rng):
+    a = rng.normal(size=(5, 30))
+    b = rng.normal(0.5, 1, size=(5, 30))
+    pvalues = mvip.permutation_test([a, b], mvip.ranksums_rank_statistic, n_permutations=20000, seeds=1)
+    expected = [scipy.stats.ranksums(x, y).pvalue for x, y in zip(a, b)]
+    np.testing.assert_allclose(pvalues, expected, atol=0.01)
+
+
+def test_permutation_streams_differ_between_rows(rng):
+    # Identical rows get independent shuffles, so their p-values differ
+    a = np.tile(rng.normal(size=12), (2, 1))
+    b = np.tile(rng.normal(0.5, 1, size=12), (2, 1))
+    pvalues = mvip.permutation_test([a, b], mvip.ranksums_rank_statistic, n_permutations=2000, seeds=0)
+    assert pvalues[0] != pvalues[1]
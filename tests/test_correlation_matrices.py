@@ -0,0 +1,85 @@
+import pickle
+import random
+import numpy as np
+import pandas as pd
+import pytest
+
+import correlations as corr
+from correlation_store import LazyCorrelationMatrix, write_packed
+from synthetic import make_screen
+
+
+@pytest.fixture(scope='module')
+def profiles():
+    return np.random.default_rng(0).normal(size=(120, 32))
+
+
+def test_lazy_matrix_matches_corrcoef(profiles):
+    expected = np.corrcoef(profiles)
+    lazy = LazyCorrelationMatrix(profiles, dtype=np.float64)
+    rows = np.array([3, 7, 7, 50, 119])
+    np.testing.assert_allclose(lazy[:, :], expected, atol=1e-12)
+    np.testing.assert_allclose(lazy[rows[:, np.newaxis], rows], expected[rows[:, np.newaxis], rows], atol=1e-12)
+    np.testing.assert_allclose(lazy[rows, rows[::-1]], expected[rows, rows[::-1]], atol=1e-12)
+    # Upper triangles of many groups are computed as scattered pairs
+    groups = np.random.default_rng(1).integers(0, len(profiles), size=(200, 8))
+    np.testing.assert_allclose(corr.batch_median_correlation(groups, lazy),
+                               corr.batch_median_correlation(groups, expected), atol=1e-12)
+
+
+def test_lazy_matrix_float32(profiles):
+    lazy = LazyCorrelationMatrix(profiles)
+    np.testing.assert_allclose(lazy[:, :], np.corrcoef(profiles), atol=1e-5)
+
+
+# Packed matrices return float32 values
+def test_packed_matrix_matches_corrcoef(profiles, tmp_path):
+    expected = np.corrcoef(profiles).astype(np.float32)
+    packed = write_packed(expected, str(tmp_path / 'matrix'), block_size=16)
+    np.testing.assert_array_equal(packed.to_array(), expected)
+    rows = np.array([[0], [5], [119]])
+    cols = np.array([119, 2, 5, 5])
+    np.testing.assert_array_equal(packed[rows, cols], expected[rows, cols])
+    np.testing.assert_array_equal(packed[-1, 3], expected[-1, 3])
+
+    subset = np.array([10, 4, 80])
+    np.testing.assert_array_equal(packed.take(subset).to_array(), expected[np.ix_(subset, subset)])
+    copy = pickle.loads(pickle.dumps(packed.take(subset)))
+    np.testing.assert_array_equal(copy.to_array(), expected[np.ix_(subset, subset)])
+
+
+def test_packed_matrix_from_frame(profiles, tmp_path):
+    expected = np.corrcoef(profiles)
+    packed = write_packed(pd.DataFrame(expected), str(tmp_path / 'matrix'), dtype=np.float64,
+                          labels=range(len(expected)))
+    assert packed.to_array().dtype == np.float32
+    np.testing.assert_array_equal(packed.to_array(), expected.astype(np.float32))
+    assert packed.labels == list(range(len(expected)))
+
+
+# The control table gives the same matrix as the per-replicate lookup of the
+# metadata, with the same draws of the random module
+def test_allele_to_control_matrix_table():
+    metadata, features, alleles = make_screen(n_genes=4, seed=1)
+    corr_matrix = np.corrcoef(features)
+    ctl_mask = metadata['Metadata_broad_sample_type'] == 'control'
+    table = corr.control_index_table(metadata, 'Metadata_Plate', ctl_mask)
+    rows = metadata.index[metadata['x_mutation_status'] == alleles[0]]
+    for control_samples in [20, 40]:
+        random.seed(3)
+        expected = corr.allele_to_control_matrix(rows, metadata, 'Metadata_Plate', ctl_mask, control_samples,
+                                                 corr_matrix)
+        random.seed(3)
+        result = corr.allele_to_control_matrix(rows, metadata, 'Metadata_Plate', ctl_mask, control_samples,
+                                               corr_matrix, control_table=table)
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_null_distribution_chunks():
+    corr_matrix = np.corrcoef(np.random.default_rng(0).normal(size=(200, 16)))
+    rows = np.arange(0, 200, 2)
+    expected = corr.null_distribution(rows, corr_matrix, 8, repeats=50, chunk_size=50,
+                                      rng=np.random.default_rng(1))
+    result = corr.null_distribution(rows, corr_matrix, 8, repeats=50, chunk_size=7,
+                                    rng=np.random.default_rng(1))
+    assert result == expected
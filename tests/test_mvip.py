@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import correlations as corr
+import mvip
+from synthetic import make_screen
+
+
+@pytest.fixture(scope='module')
+def screen():
+    metadata, features, alleles = make_screen(n_genes=4, seed=1)
+    corr_matrix = np.corrcoef(features)
+    treated = metadata[metadata['Metadata_broad_sample_type'] == 'trt']
+    null = corr.null_distribution(treated.index, corr_matrix, 8, repeats=50, rng=np.random.default_rng(0))
+    return metadata, corr_matrix, alleles, null
+
+
+def make_vip(screen, cls=mvip.Morphology_VIP_CNN_Features, **options):
+    metadata, corr_matrix, _, _ = screen
+    return cls(metadata, corr_matrix, treatment_samples=8, control_samples=20,
+               perturbation_field='x_mutation_status', **options)
+
+
+def run_allele_set(screen, n_jobs=1, **options):
+    _, _, alleles, null = screen
+    return make_vip(screen, **options).test_allele_set(alleles, null_distribution=null, seed=0, n_jobs=n_jobs)
+
+
+@pytest.mark.parametrize('options', [{}, {'n_resamples': 4}, {'test_engine': 'permutation', 'n_permutations': 200}])
+def test_parallel_matches_serial(screen, options):
+    serial = run_allele_set(screen, n_jobs=1, **options)
+    parallel = run_allele_set(screen, n_jobs=2, **options)
+    pd.testing.assert_frame_equal(parallel, serial)
+    assert len(serial) == len(screen[2])
+
+
+def test_seed_is_reproducible(screen):
+    pd.testing.assert_frame_equal(run_allele_set(screen), run_allele_set(screen))
+
+
+def test_permutation_batches(screen):
+    options = {'test_engine': 'permutation', 'n_permutations': 200}
+    batched = run_allele_set(screen, **options)
+    single = run_allele_set(screen, batch_alleles=False, **options)
+    pd.testing.assert_frame_equal(batched, single)
+    # evaluate on its own returns complete records
+    vip = make_vip(screen, **options)
+    vip.null_dist = screen[3]
+    record = vip.evaluate(batched['wild_type'][0], batched['mutant'][0], rng=np.random.default_rng(0))
+    assert '_medians' not in record and 0 < record['impact_test'] <= 1
+
+
+def test_permutation_rejects_resampling(screen):
+    with pytest.raises(ValueError):
+        make_vip(screen, test_engine='permutation', n_resamples=4)
+
+
+def test_adjust_pvalues(screen):
+    results = run_allele_set(screen)
+    adjusted = make_vip(screen).adjust_pvalues(results.copy(), Q=0.05)
+    pd.testing.assert_frame_equal(adjusted, mvip.adjust_cnn_feature_pvalues(results.copy(), Q=0.05))
+    assert set(adjusted['prediction']) <= {'NI', 'GOF', 'LOF', 'COF', 'NT'}
+    strict = mvip.adjust_cnn_feature_pvalues(results.copy(), Q=1e-12)
+    assert strict['is_sig_impact_test'].sum() <= adjusted['is_sig_impact_test'].sum()
+
+
+def test_update_index(screen, capsys):
+    vip = make_vip(screen)
+    results = vip.test_allele_set(screen[2], null_distribution=screen[3], seed=0)
+    missing = pd.DataFrame([{'wild_type': 'X_WT', 'mutant': 'X_1'}, {'wild_type': results['wild_type'][0],
+                                                                      'mutant': 'missing'}])
+    vip.update_index(pd.concat([results, missing], ignore_index=True), 'vip')
+    assert capsys.readouterr().out.split('\n')[-3:-1] == ['X_WT missing in index', 'missing missing in index']
+    entries = {child['name']: child for gene in vip.index['children'] for child in gene['children']}
+    assert [entries[m]['vip']['mutant'] for m in results['mutant']] == list(results['mutant'])
+    assert [gene['name'] for gene in vip.index['children']] == sorted(set(results['wild_type']))
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+import neighbors
+
+
+# nearest_neighbors of notebook 5, with the cosine distances of NumPy
+# instead of TensorFlow
+def reference_nearest_neighbors(CTL, WT, MUT, K=5):
+    ALL = np.concatenate([CTL, WT, MUT], axis=0)
+    normalized = ALL / np.linalg.norm(ALL, axis=1, keepdims=True)
+    D = 1 - np.dot(normalized, normalized.T)
+    D[np.diag_indices(D.shape[0])] = 10
+    NN = []
+    for nn in range(K):
+        nnx = np.argmin(D, axis=0)
+        D[nnx, np.arange(D.shape[0])] = 1e6
+        NN.append(nnx)
+    return np.concatenate([x[:, np.newaxis] for x in NN], axis=1)
+
+
+@pytest.fixture(scope='module')
+def cells():
+    rng = np.random.default_rng(0)
+    return rng.normal(size=(300, 16)), rng.normal(0.3, 1, size=(150, 16)), rng.normal(-0.3, 1, size=(150, 16))
+
+
+@pytest.mark.parametrize('block_size, n_jobs', [(1024, 1), (64, 1), (64, 3)])
+def test_nearest_neighbors_matches_notebook(cells, block_size, n_jobs):
+    CTL, WT, MUT = cells
+    expected = reference_nearest_neighbors(CTL, WT, MUT)
+    results, all_values, NN = neighbors.nearest_neighbors(CTL, WT, MUT, block_size=block_size, n_jobs=n_jobs,
+                                                          return_neighbors=True)
+    np.testing.assert_array_equal(NN, expected)
+    types = neighbors.neighbor_types(expected, len(CTL), len(WT))
+    assert neighbors.neighborhood_scores(types, len(MUT))[1] == all_values
+    assert sum(all_values) == len(CTL) + len(WT) + len(MUT)
+
+
+def test_missing_neighbors_have_no_type():
+    types = neighbors.neighbor_types(np.array([[0, 5, 12, -1]]), 5, 5)
+    assert types.tolist() == [[neighbors.CTL, neighbors.WT, neighbors.MUT, neighbors.MISSING]]
+
+
+def test_ann_exhaustive_probe_is_exact(cells):
+    CTL, WT, MUT = cells
+    index = neighbors.IVFIndex(n_lists=8, n_probe=8, n_jobs=1).fit(CTL)
+    expected = reference_nearest_neighbors(CTL, WT, MUT)
+    for _ in range(2):
+        # The second call uses the cached control neighbors
+        results, all_values, NN = neighbors.ann_nearest_neighbors(index, WT, MUT, n_jobs=1, return_neighbors=True)
+        np.testing.assert_array_equal(np.sort(NN, axis=1), np.sort(expected, axis=1))
+        assert results['recall'] == 1.0
+    assert len(index._neighbors) == 1
@@ -0,0 +1,73 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+
+import profiling
+
+NUM_FEATS = 4
+
+
+def write_site(plate, well, site, rng, nan=False):
+    path = f'outputs/exp/features/{plate}/{well}_s{site}.npz'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    features = rng.normal(size=(5, NUM_FEATS))
+    if nan:
+        features[0, 0] = np.nan
+    metadata = np.array({'Metadata_Plate': plate, 'Metadata_Well': well}, dtype=object)
+    np.savez(path, features=features, metadata=metadata)
+    return path
+
+
+def full_profiles():
+    profiling.aggregate_plates('exp', profiling.list_plates('exp'), 'full.parquet', NUM_FEATS, workers=1)
+    return pd.read_parquet('full.parquet')
+
+
+def incremental_profiles():
+    profiling.update_plates('exp', profiling.list_plates('exp'), 'out', NUM_FEATS, 'state', workers=1)
+    return pd.concat([pd.read_parquet(os.path.join('out', f)) for f in sorted(os.listdir('out'))],
+                     ignore_index=True)
+
+
+def assert_same_profiles(result, expected):
+    sort = ['Metadata_Plate', 'Metadata_Well']
+    pd.testing.assert_frame_equal(result.sort_values(sort).reset_index(drop=True),
+                                  expected.sort_values(sort).reset_index(drop=True))
+
+
+@pytest.fixture
+def screen(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(0)
+    for plate in ['52600', '52601']:
+        for well in ['A01', 'A02', 'B01']:
+            for site in [1, 2]:
+                write_site(plate, well, site, rng)
+    write_site('52600', 'B01', 3, rng, nan=True)
+    return rng
+
+
+def test_incremental_matches_full(screen):
+    assert_same_profiles(incremental_profiles(), full_profiles())
+
+
+def test_incremental_after_changes(screen):
+    incremental_profiles()
+    rng = screen
+    # New site, modified site, removed site and removed plate
+    write_site('52600', 'A01', 3, rng)
+    path = write_site('52600', 'A02', 1, rng)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    os.remove('outputs/exp/features/52600/B01_s2.npz')
+    shutil.rmtree('outputs/exp/features/52601')
+    result = incremental_profiles()
+    assert_same_profiles(result, full_profiles())
+    assert sorted(os.listdir('out')) == ['52600.parquet']
+
+
+def test_incremental_unchanged_plate_is_not_read(screen):
+    incremental_profiles()
+    assert profiling.update_plate('exp', '52600', NUM_FEATS, 'state', 'out') == ('52600', 0)
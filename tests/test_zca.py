@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from zca import ZCA, AllControlsNormalizer
+
+
+# Batch ZCA of the original zca.py: covariance of all rows, SVD and
+# (X - mean) W'
+def reference_zca(X, regularization, ddof=1):
+    mean = X.mean(axis=0)
+    centered = X - mean
+    sigma = np.dot(centered.T, centered) / (X.shape[0] - ddof)
+    U, S, V = np.linalg.svd(sigma)
+    W = np.dot(U * (1 / np.sqrt(S + regularization)), U.T)
+    return mean, W, np.dot(centered, W.T)
+
+
+@pytest.fixture(scope='module')
+def data():
+    rng = np.random.default_rng(0)
+    mixing = rng.normal(size=(20, 20))
+    return rng.normal(size=(1000, 20)).dot(mixing) + rng.normal(size=20) * 5
+
+
+@pytest.mark.parametrize('ddof', [0, 1])
+def test_streaming_fit_matches_batch(data, ddof):
+    mean, W, expected = reference_zca(data, 0.1, ddof=ddof)
+    model = ZCA(regularization=0.1, chunk_size=64, ddof=ddof).fit(data)
+    np.testing.assert_allclose(model.mean_, mean, atol=1e-10)
+    np.testing.assert_allclose(model.components_, W, atol=1e-10)
+    np.testing.assert_allclose(model.transform(data), expected, atol=1e-9)
+
+
+def test_fit_stream_uneven_chunks(data):
+    _, _, expected = reference_zca(data, 0.1)
+    bounds = [0, 1, 37, 400, 401, 1000]
+    model = ZCA(regularization=0.1).fit_stream(data[a:b] for a, b in zip(bounds[:-1], bounds[1:]))
+    np.testing.assert_allclose(model.transform(data), expected, atol=1e-9)
+
+
+def test_auto_regularization(data):
+    model = ZCA(retain_variance=0.9).fit(data)
+    S = np.linalg.svd(np.cov(data.T))[1]
+    assert model.regularization == pytest.approx(S[(np.cumsum(S / S.sum()) < 0.9).sum()])
+
+
+def test_transform_in_place_and_float32(data):
+    model = ZCA(regularization=0.1, chunk_size=100).fit(data)
+    expected = model.transform(data)
+    X = data.copy()
+    model.transform(X, out=X)
+    np.testing.assert_array_equal(X, expected)
+    np.testing.assert_allclose(model.transform(data.astype(np.float32)), expected, atol=1e-4)
+
+
+@pytest.mark.parametrize('low_rank', [False, True])
+def test_save_and_load(data, tmp_path, low_rank):
+    model = ZCA(regularization=0.1, low_rank=low_rank).fit(data)
+    expected = model.transform(data)
+    model.save(str(tmp_path / 'zca.npz'))
+    model.save_shared(str(tmp_path / 'shared'))
+    for path in ['zca.npz', 'shared']:
+        loaded = ZCA.load(str(tmp_path / path))
+        np.testing.assert_allclose(loaded.transform(data), expected, atol=1e-12)
+        assert loaded.fingerprint() == model.fingerprint()
+
+
+def test_all_controls_normalizer(data):
+    model = AllControlsNormalizer(dtype=np.float64, chunk_size=100).fit(data)
+    expected = (data - data.mean()) / data.std()
+    np.testing.assert_allclose(model.transform(data, out=np.empty_like(data)), expected, atol=1e-10)
@@ -4,17 +4,12 @@ Script to extract locations from CellProfiler
 import sqlite3
 import argparse
 import csv
-from collections import defaultdict
 import os.path
+import pathlib
+import sys
 from os import makedirs
-
-parser = argparse.ArgumentParser(
-    description='Extract locations from SQLite database generated by CellProfiler')
-parser.add_argument('dbpath', help='.db file location')
-parser.add_argument(
-    'csvdir', help='destination folder to write locations in csv format')
-
-args = parser.parse_args()
+from glob import glob
+from multiprocessing import Pool
 
 QUERY = '''
 SELECT
@@ -28,21 +23,110 @@ FROM
     Nuclei
 JOIN Image ON
     Image.TableNumber = Nuclei.TableNumber
+ORDER BY
+    Image_Metadata_Well, Image_Metadata_Site, Nuclei.TableNumber, Nuclei.ObjectNumber
 '''
-locations = defaultdict(list)
-with sqlite3.connect(args.dbpath) as conn:
-    cur = conn.cursor()
-    for row in cur.execute(QUERY):
-        fname, plate_id, site_id, well_id, xpos, ypos = row
-        csvfile = f'{well_id}-{site_id}-Nuclei.csv'
-        locations[csvfile].append((xpos, ypos))
-
-makedirs(args.csvdir, exist_ok=True)
-header = 'Nuclei_Location_Center_X', 'Nuclei_Location_Center_Y'
-for csvfile, values in locations.items():
-    csvpath = os.path.join(args.csvdir, csvfile)
-    with open(csvpath, 'w', newline='', encoding='utf-8') as fpointer:
-        writer = csv.writer(fpointer)
-        writer.writerow(header)
-        for row in values:
-            writer.writerow(row)
+HEADER = 'Nuclei_Location_Center_X', 'Nuclei_Location_Center_Y'
+FETCH_SIZE = 50000
+# Memory mapped bytes and page cache (KiB) of all open databases together.
+# extract_plates divides them among its workers.
+MMAP_BUDGET = 2**30
+CACHE_BUDGET = 2**18
+
+
+# Open a CellProfiler database read-only, with a page cache and memory
+# mapped reads
+def connect_readonly(dbpath, mmap_size=MMAP_BUDGET, cache_size=CACHE_BUDGET):
+    uri = pathlib.Path(dbpath).resolve().as_uri() + '?mode=ro'
+    conn = sqlite3.connect(uri, uri=True)
+    conn.execute(f'PRAGMA mmap_size={mmap_size}')
+    # Negative values are in KiB
+    conn.execute(f'PRAGMA cache_size=-{cache_size}')
+    conn.execute('PRAGMA query_only=1')
+    return conn
+
+
+# Stream nuclei rows ordered by well and site, and write the csv file of
+# each site as soon as all its rows are read. Within a site, nuclei are in
+# object number order, which defines the cell numbering of DeepProfiler.
+def extract_locations(dbpath, csvdir, mmap_size=MMAP_BUDGET, cache_size=CACHE_BUDGET):
+    makedirs(csvdir, exist_ok=True)
+    current, fpointer, writer = None, None, None
+    num_files = 0
+    conn = connect_readonly(dbpath, mmap_size=mmap_size, cache_size=cache_size)
+    try:
+        cur = conn.execute(QUERY)
+        while True:
+            rows = cur.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for fname, plate_id, site_id, well_id, xpos, ypos in rows:
+                if (well_id, site_id) != current:
+                    if fpointer is not None:
+                        fpointer.close()
+                    current = (well_id, site_id)
+                    csvpath = os.path.join(csvdir, f'{well_id}-{site_id}-Nuclei.csv')
+                    fpointer = open(csvpath, 'w', newline='', encoding='utf-8')
+                    writer = csv.writer(fpointer)
+                    writer.writerow(HEADER)
+                    num_files += 1
+                writer.writerow((xpos, ypos))
+    finally:
+        if fpointer is not None:
+            fpointer.close()
+        conn.close()
+    return num_files
+
+
+def _extract_plate(args):
+    dbpath, csvdir, mmap_size, cache_size = args
+    try:
+        return dbpath, extract_locations(dbpath, csvdir, mmap_size, cache_size), None
+    except (sqlite3.Error, OSError) as e:
+        return dbpath, 0, e
+
+
+# Extract several plates in parallel, one database per worker. Returns the
+# databases that failed.
+def extract_plates(sqlite_dir, locations_dir, plates=None, workers=None):
+    if not plates:
+        plates = sorted(os.path.basename(p)[:-len('.sqlite')] for p in glob(os.path.join(sqlite_dir, '*.sqlite')))
+    workers = min(workers or os.cpu_count() or 1, max(len(plates), 1))
+    tasks = [(os.path.join(sqlite_dir, f'{plate}.sqlite'), os.path.join(locations_dir, plate),
+              MMAP_BUDGET // workers, CACHE_BUDGET // workers)
+             for plate in plates]
+    failed = []
+    with Pool(workers) as pool:
+        # A failing plate is reported and does not stop the others
+        for dbpath, num_files, error in pool.imap_unordered(_extract_plate, tasks):
+            if error is not None:
+                print(f'{dbpath}: {error}')
+                failed.append(dbpath)
+            else:
+                print(f'{dbpath}: {num_files} location files')
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Extract locations from SQLite database generated by CellProfiler')
+    parser.add_argument('dbpath', nargs='?', help='.db file location')
+    parser.add_argument(
+        'csvdir', nargs='?', help='destination folder to write locations in csv format')
+    parser.add_argument('--sqlite-dir', default='inputs/locations/sqlite',
+                        help='folder with <plate>.sqlite files, used when dbpath is not given')
+    parser.add_argument('--locations-dir', default='inputs/locations',
+                        help='locations are written to <locations-dir>/<plate>/')
+    parser.add_argument('--plates', nargs='*', help='plates to extract (default: all databases in --sqlite-dir)')
+    parser.add_argument('--workers', type=int, help='number of plates extracted in parallel')
+    args = parser.parse_args()
+
+    if args.dbpath is not None:
+        if args.csvdir is None:
+            parser.error('csvdir is required with dbpath')
+        extract_locations(args.dbpath, args.csvdir)
+    else:
+        failed = extract_plates(args.sqlite_dir, args.locations_dir, args.plates, workers=args.workers)
+        if failed:
+            print(f'{len(failed)} of the plates failed: {" ".join(sorted(failed))}', file=sys.stderr)
+            sys.exit(1)
@@ -1,54 +1,129 @@
+import os
 import re
-import sqlite3
 import numpy as np
 import pandas as pd
 from skimage.io import imread, imsave
 from skimage.draw import rectangle
+from extract_locations import connect_readonly
 
 DB_PATH_TPL = 'inputs/locations/sqlite/{plate_id}.sqlite'
-QUERY = '''
+INDEX_PATH_TPL = 'inputs/locations/index/{plate_id}.npz'
+IMAGE_QUERY = '''
 SELECT
-    Image_FileName_OrigDNA,
+    TableNumber,
+    Image_FileName_OrigDNA
+FROM
+    Image
+'''
+NUCLEI_QUERY = '''
+SELECT
+    TableNumber,
     CAST(Nuclei_Location_Center_X AS INTEGER),
     CAST(Nuclei_Location_Center_Y AS INTEGER)
 FROM
     Nuclei
-JOIN Image ON
-    Image.TableNumber = Nuclei.TableNumber
-WHERE
-    Image_FileName_OrigDNA like :pattern
 '''
-PATTERN_TPL = '%_{well_id}_s{site_id}%'
+# Well and site in the file name, as matched by the old '%_{well}_s{site}%' pattern
+image_rgx = re.compile(r'.*_(\w\d+)_s(\d+)')
+
+# One connection and one location index per plate, reused by all lookups
+connections = {}
+indexes = {}
+
+
+def get_connection(plate_id):
+    if plate_id not in connections:
+        connections[plate_id] = connect_readonly(DB_PATH_TPL.format(plate_id=plate_id))
+    return connections[plate_id]
+
+
+# Size and modification time of the sqlite file of a plate, stored in its
+# index to detect a re-extracted or replaced database
+def database_signature(plate_id):
+    st = os.stat(DB_PATH_TPL.format(plate_id=plate_id))
+    return np.asarray([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+
+# Read all nucleus centers of a plate once and store them sorted by
+# (well, site), with the offsets of every site
+def build_location_index(plate_id):
+    signature = database_signature(plate_id)
+    conn = get_connection(plate_id)
+    image_keys = {}
+    for table_number, fname in conn.execute(IMAGE_QUERY):
+        match = image_rgx.match(fname)
+        if match is not None:
+            well_id, site_id = match.groups()
+            image_keys[table_number] = (well_id, site_id)
+    keys = sorted(set(image_keys.values()))
+    key_pos = {key: i for i, key in enumerate(keys)}
+    key_ids = {table_number: key_pos[key] for table_number, key in image_keys.items()}
+
+    nuclei = pd.DataFrame(conn.execute(NUCLEI_QUERY).fetchall(), columns=['table_number', 'x', 'y'])
+    nuclei['key_id'] = nuclei['table_number'].map(key_ids)
+    nuclei = nuclei.dropna(subset=['key_id']).sort_values('key_id', kind='stable')
+    key_id = nuclei['key_id'].to_numpy(dtype=np.int64)
+    offsets = np.searchsorted(key_id, np.arange(len(keys) + 1))
+
+    index_path = INDEX_PATH_TPL.format(plate_id=plate_id)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    np.savez(index_path,
+             wells=np.asarray([k[0] for k in keys], dtype=str),
+             sites=np.asarray([k[1] for k in keys], dtype=str),
+             offsets=offsets,
+             locations=nuclei[['x', 'y']].to_numpy(dtype=np.int32),
+             signature=signature)
+
+
+def is_index_current(index_path, plate_id):
+    if not os.path.exists(index_path):
+        return False
+    with np.load(index_path) as vals:
+        return 'signature' in vals and np.array_equal(vals['signature'], database_signature(plate_id))
+
+
+# Location index of a plate, built and cached on disk the first time, and
+# rebuilt when the sqlite file has changed since
+def get_location_index(plate_id):
+    if plate_id not in indexes:
+        index_path = INDEX_PATH_TPL.format(plate_id=plate_id)
+        if not is_index_current(index_path, plate_id):
+            print(f'building location index {index_path}')
+            build_location_index(plate_id)
+        with np.load(index_path) as vals:
+            keys = zip(vals['wells'].tolist(), vals['sites'].tolist())
+            indexes[plate_id] = {
+                'sites': {key: i for i, key in enumerate(keys)},
+                'offsets': vals['offsets'],
+                'locations': vals['locations'],
+            }
+    return indexes[plate_id]
 
 
 def get_locations(plate_id, well_id, site_id):
-    locations = []
-    dbpath = DB_PATH_TPL.format(plate_id=plate_id)
-    with sqlite3.connect(dbpath) as conn:
-        print(f'connected to {dbpath}')
-        conn.set_trace_callback(print)
-        cur = conn.cursor()
-        param = PATTERN_TPL.format(well_id=well_id, site_id=site_id)
-        result = cur.execute(QUERY, {'pattern': param})
-        for _, xpos, ypos in result:
-            locations.append((xpos, ypos))
-    return np.asarray(locations)
-
-
-im_root = 'outputs/compressed/images'
-index = pd.read_csv('inputs/metadata/index.csv')
-sample = index.sample(10, random_state=123)
-
-fname_rgx = re.compile(r'(\d+)/(.*)_(\w\d+)_s(\d)_.*')
-
-for i, row in sample.iterrows():
-    plate_id, _, well_id, site_id = fname_rgx.match(row['DNA']).groups()
-    impath = im_root + '/' + row['DNA'].split('.')[0] + '.png'
-    im = imread(impath)
-    print(f'getting centers from {impath}')
-    locations = get_locations(plate_id, well_id, site_id)
-    for loc in locations:
-        topleft = loc[::-1] - 5
-        rr, cc = rectangle(topleft, extent=(10, 10), shape=im.shape)
-        im[rr, cc] = 255
-    imsave(f'{i}.png', im)
+    index = get_location_index(plate_id)
+    i = index['sites'].get((well_id, str(site_id)))
+    if i is None:
+        return np.empty((0, 2), dtype=np.int32)
+    start, stop = index['offsets'][i], index['offsets'][i + 1]
+    return index['locations'][start:stop]
+
+
+if __name__ == '__main__':
+    im_root = 'outputs/compressed/images'
+    index = pd.read_csv('inputs/metadata/index.csv')
+    sample = index.sample(10, random_state=123)
+
+    fname_rgx = re.compile(r'(\d+)/(.*)_(\w\d+)_s(\d)_.*')
+
+    for i, row in sample.iterrows():
+        plate_id, _, well_id, site_id = fname_rgx.match(row['DNA']).groups()
+        impath = im_root + '/' + row['DNA'].split('.')[0] + '.png'
+        im = imread(impath)
+        print(f'getting centers from {impath}')
+        locations = get_locations(plate_id, well_id, site_id)
+        for loc in locations:
+            topleft = loc[::-1] - 5
+            rr, cc = rectangle(topleft, extent=(10, 10), shape=im.shape)
+            im[rr, cc] = 255
+        imsave(f'{i}.png', im)
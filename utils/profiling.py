@@ -0,0 +1,277 @@
+'''
+Streaming aggregation of DeepProfiler single-cell features into well profiles
+'''
+from glob import glob
+import argparse
+import json
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm.auto import tqdm
+from multiprocessing import Pool
+
+KEY_COLS = ['Metadata_Plate', 'Metadata_Well']
+
+
+def list_plates(exp_name, pattern='526*'):
+    plates = glob(f'outputs/{exp_name}/features/{pattern}')
+    plates = [p.split('/')[-1] for p in plates]
+    plates.sort()
+    return plates
+
+
+def list_sites(exp_name, plate):
+    return sorted(glob(f'outputs/{exp_name}/features/{plate}/*npz'))
+
+
+# Mean feature vector of the cells in one site, or None if the site has NaN
+# features. Returns the metadata dict of the site as well.
+def read_site(npzpath):
+    with np.load(npzpath, allow_pickle=True) as vals:
+        features = vals['features']
+        metadata = vals['metadata'].item()
+    if np.isnan(features).any():
+        return metadata, None
+    return metadata, features.mean(axis=0, dtype=np.float64)
+
+
+# Running sums and counts of site profiles per well. The well profile is
+# the mean of its site profiles, as in the original groupby-mean.
+class WellAccumulator(object):
+
+    def __init__(self, num_feats, dtype=np.float64):
+        self.num_feats = num_feats
+        self.dtype = dtype
+        self.sums = {}
+        self.counts = {}
+
+    def reset(self, key):
+        self.sums.pop(key, None)
+        self.counts.pop(key, None)
+
+    def add(self, key, profile, count=1):
+        if key not in self.sums:
+            self.sums[key] = np.zeros(self.num_feats, dtype=self.dtype)
+            self.counts[key] = 0
+        self.sums[key] += profile
+        self.counts[key] += count
+
+    def keys(self):
+        return sorted(self.sums)
+
+    # (wells x features) matrix of well means, in column-major order so
+    # that every feature column can be handed to Arrow without a copy
+    def means(self, keys=None):
+        keys = self.keys() if keys is None else keys
+        means = np.empty((len(keys), self.num_feats), dtype=np.float64, order='F')
+        for i, key in enumerate(keys):
+            means[i] = self.sums[key] / self.counts[key]
+        return means
+
+    # extra arrays are saved in the same file (e.g. the manifest of the
+    # incremental mode), which is replaced atomically
+    def save(self, path, **extra):
+        keys = self.keys()
+        sums = np.asarray([self.sums[k] for k in keys], dtype=self.dtype).reshape(len(keys), self.num_feats)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path,
+                 plates=np.asarray([k[0] for k in keys]),
+                 wells=np.asarray([k[1] for k in keys]),
+                 sums=sums,
+                 counts=np.asarray([self.counts[k] for k in keys], dtype=np.int64),
+                 **extra)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, num_feats, dtype=np.float64):
+        acc = cls(num_feats, dtype=dtype)
+        with np.load(path) as vals:
+            if vals['sums'].shape[1] != num_feats:
+                raise ValueError(f'{path} has {vals["sums"].shape[1]} features, expected {num_feats}')
+            for plate, well, sums, count in zip(vals['plates'].tolist(), vals['wells'].tolist(),
+                                                vals['sums'], vals['counts']):
+                acc.sums[(plate, well)] = sums.astype(dtype)
+                acc.counts[(plate, well)] = int(count)
+        return acc
+
+
+# Plate and well of a site as plain python values
+def well_key(metadata):
+    plate, well = metadata['Metadata_Plate'], metadata['Metadata_Well']
+    plate = plate.item() if isinstance(plate, np.generic) else plate
+    well = well.item() if isinstance(well, np.generic) else well
+    return plate, well
+
+
+def profiles_batch(keys, means):
+    plates = pa.array([k[0] for k in keys])
+    wells = pa.array([k[1] for k in keys])
+    columns = [pa.array(means[:, i]) for i in range(means.shape[1])]
+    names = KEY_COLS + [str(i) for i in range(means.shape[1])]
+    return pa.RecordBatch.from_arrays([plates, wells] + columns, names=names)
+
+
+def aggregate_plate(exp_name, plate, num_feats):
+    acc = WellAccumulator(num_feats)
+    for npzpath in tqdm(list_sites(exp_name, plate), leave=False):
+        metadata, profile = read_site(npzpath)
+        # Ignore nan
+        if profile is None:
+            continue
+        acc.add(well_key(metadata), profile)
+    keys = acc.keys()
+    return profiles_batch(keys, acc.means(keys))
+
+
+def _aggregate_plate(args):
+    return aggregate_plate(*args)
+
+
+# Aggregate the plates in a pool of workers and append every plate to the
+# parquet output as soon as it is ready
+def aggregate_plates(exp_name, plates, output, num_feats, workers=None):
+    writer = None
+    tasks = [(exp_name, plate, num_feats) for plate in plates]
+    with Pool(workers) as pool:
+        batches = pool.imap(_aggregate_plate, tasks)
+        try:
+            for batch in tqdm(batches, total=len(tasks)):
+                if batch.num_rows == 0:
+                    continue
+                if writer is None:
+                    writer = pq.ParquetWriter(output, batch.schema)
+                writer.write_table(pa.Table.from_batches([batch]))
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+################################################################################
+## INCREMENTAL MODE
+################################################################################
+# The state directory keeps, for every plate, a manifest of the site files
+# that were read (size, mtime and well) and the per-well partial sums, in
+# one <plate>.npz file so that both are always saved together.
+# On a rerun, only new or modified files are read. Wells that lost or
+# changed a file are rebuilt from their current files. Each plate is
+# written to its own parquet file in the output directory, and only plates
+# with changes are rewritten. The parquet file is written before the state:
+# if a run stops in between, the next run reads the changed files again.
+
+def file_stats(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+# Manifest and partial sums of a plate. States of older versions, with the
+# manifest in a separate json file, are rebuilt from scratch.
+def load_state(path, num_feats):
+    if os.path.exists(path):
+        with np.load(path) as vals:
+            manifest = json.loads(vals['manifest'].item())['files'] if 'manifest' in vals.files else None
+        if manifest is not None:
+            return manifest, WellAccumulator.load(path, num_feats)
+    return {}, WellAccumulator(num_feats)
+
+
+def save_state(path, manifest, acc):
+    acc.save(path, manifest=np.asarray(json.dumps({'files': manifest})))
+    legacy_manifest = path[:-len('.npz')] + '.json'
+    if os.path.exists(legacy_manifest):
+        os.remove(legacy_manifest)
+
+
+# Delete the output and the state of a plate that has no sites any more
+def remove_plate(plate, state_dir, output_dir):
+    for path in [os.path.join(output_dir, f'{plate}.parquet'), os.path.join(state_dir, f'{plate}.npz'),
+                 os.path.join(state_dir, f'{plate}.json')]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def update_plate(exp_name, plate, num_feats, state_dir, output_dir):
+    state_path = os.path.join(state_dir, f'{plate}.npz')
+    partition_path = os.path.join(output_dir, f'{plate}.parquet')
+    manifest, acc = load_state(state_path, num_feats)
+
+    current = {path: file_stats(path) for path in list_sites(exp_name, plate)}
+    if not current:
+        remove_plate(plate, state_dir, output_dir)
+        return plate, 0
+    changed = [p for p, stats in current.items()
+               if p in manifest and (manifest[p]['size'], manifest[p]['mtime']) != (stats['size'], stats['mtime'])]
+    removed = [p for p in manifest if p not in current]
+    added = [p for p in current if p not in manifest]
+    if not changed and not removed and not added and os.path.exists(partition_path):
+        return plate, 0
+
+    # Wells that lost a contribution are rebuilt from all their current files
+    dirty = set(tuple(manifest[p]['well']) for p in changed + removed)
+    for key in dirty:
+        acc.reset(key)
+    for p in removed:
+        del manifest[p]
+    to_read = set(added + changed)
+    to_read.update(p for p, entry in manifest.items() if tuple(entry['well']) in dirty)
+
+    for npzpath in tqdm(sorted(to_read), leave=False):
+        metadata, profile = read_site(npzpath)
+        key = well_key(metadata)
+        manifest[npzpath] = dict(current[npzpath], well=list(key), skipped=profile is None)
+        # Ignore nan
+        if profile is not None:
+            acc.add(key, profile)
+
+    keys = acc.keys()
+    table = pa.Table.from_batches([profiles_batch(keys, acc.means(keys))])
+    # Hidden temporary name, so readers of the output directory skip it
+    tmp_path = os.path.join(output_dir, f'.{plate}.parquet.tmp')
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, partition_path)
+    save_state(state_path, manifest, acc)
+    return plate, len(to_read)
+
+
+def _update_plate(args):
+    return update_plate(*args)
+
+
+def update_plates(exp_name, plates, output_dir, num_feats, state_dir, workers=None):
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(state_dir, exist_ok=True)
+    # Plates whose feature directory was deleted
+    for path in glob(os.path.join(state_dir, '*.npz')):
+        plate = os.path.basename(path)[:-len('.npz')]
+        if not os.path.isdir(f'outputs/{exp_name}/features/{plate}'):
+            remove_plate(plate, state_dir, output_dir)
+    tasks = [(exp_name, plate, num_feats, state_dir, output_dir) for plate in plates]
+    with Pool(workers) as pool:
+        for plate, num_read in tqdm(pool.imap(_update_plate, tasks), total=len(tasks)):
+            if num_read > 0:
+                print(f'{plate}: {num_read} sites read')
+
+
+def main(default_output='{exp_name}_profiles.parquet'):
+    parser = argparse.ArgumentParser(
+        description='Aggregate DeepProfiler single-cell features into well profiles')
+    parser.add_argument('--exp-name', default='efn_pretrained',
+                        help='DeepProfiler experiment, features are read from outputs/<exp-name>/features')
+    parser.add_argument('--num-feats', type=int, default=6400, help='number of features per cell')
+    parser.add_argument('--plates', default='526*', help='glob pattern of the plates to aggregate')
+    parser.add_argument('--output', help=f'parquet output (default: {default_output})')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only read new or modified sites and write one parquet file per plate '
+                             'into the output directory')
+    parser.add_argument('--state-dir', help='manifest and partial sums of the incremental mode '
+                                            '(default: <output>.state)')
+    parser.add_argument('--workers', type=int, help='number of worker processes')
+    args = parser.parse_args()
+
+    output = args.output or default_output.format(exp_name=args.exp_name)
+    plates = list_plates(args.exp_name, args.plates)
+    if args.incremental:
+        state_dir = args.state_dir or output + '.state'
+        update_plates(args.exp_name, plates, output, args.num_feats, state_dir, workers=args.workers)
+    else:
+        aggregate_plates(args.exp_name, plates, output, args.num_feats, workers=args.workers)
@@ -18,35 +18,292 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import hashlib
+import os
 import numpy as np
-from sklearn.utils import as_float_array
 from sklearn.base import TransformerMixin, BaseEstimator
 
-class ZCA(BaseEstimator, TransformerMixin):
 
-    def __init__(self, regularization='auto', copy=False, retain_variance=0.99):
+# Normalizers of well profiles and single cells (ZCA whitening and the
+# scaling by the mean and deviation of all control values of notebook 4).
+# They are fit from chunks of rows (fit_stream, or fit_store on the cells
+# of a SingleCellStore) and transform blocks of rows into a preallocated
+# output. A fitted normalizer can be saved with save_shared as one .npy file
+# per array; load(directory) memory maps them read-only, so worker processes
+# share one copy of the fitted state.
+class StreamingNormalizer(BaseEstimator, TransformerMixin):
+
+    def fit(self, X, y=None):
+        X = np.asarray(X)
+        self._reset()
+        for start in range(0, X.shape[0], self.chunk_size):
+            self.partial_fit(X[start:start + self.chunk_size])
+        return self.finalize()
+
+    # Fit from an iterable of 2-D chunks, e.g. batches read from parquet
+    def fit_stream(self, chunks):
+        self._reset()
+        for X in chunks:
+            self.partial_fit(X)
+        return self.finalize()
+
+    # Fit from the cells of a SingleCellStore (e.g. the rows of the controls)
+    def fit_store(self, store, rows=None, chunk_size=65536):
+        return self.fit_stream(store.iter_chunks(rows, chunk_size=chunk_size))
+
+    # Interface of the normalizers of notebook 4. The result is float32
+    # unless out is given.
+    def normalize(self, X, images=None, out=None):
+        if out is None:
+            out = np.empty(np.shape(X), dtype=np.float32)
+        return self.transform(X, out=out)
+
+    # Hash of the fitted state, e.g. to key caches of normalized data
+    def fingerprint(self):
+        digest = hashlib.sha1(type(self).__name__.encode())
+        for name, value in sorted(self._state().items()):
+            value = np.asarray(value)
+            digest.update(f'{name}:{value.dtype}:{value.shape}'.encode())
+            digest.update(np.ascontiguousarray(value).tobytes())
+        return digest.hexdigest()
+
+    # Save the fitted state as .npz (path) or as one .npy per array
+    # (save_shared(directory))
+    def save(self, path):
+        np.savez(path, **self._state())
+
+    def save_shared(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name, value in self._state().items():
+            np.save(os.path.join(directory, name + '.npy'), value)
+
+    # Load from a .npz file or from a save_shared directory. Arrays of a
+    # directory are read-only memory maps.
+    @classmethod
+    def load(cls, path):
+        if os.path.isdir(path):
+            vals = {f[0:-4]: np.load(os.path.join(path, f), mmap_mode='r')
+                    for f in os.listdir(path) if f.endswith('.npy')}
+            return cls._from_state(vals)
+        with np.load(path) as data:
+            return cls._from_state({name: data[name] for name in data.files})
+
+    def _state(self):
+        if getattr(self, '_stale', False):
+            self.finalize()
+        return {}
+
+
+class ZCA(StreamingNormalizer):
+
+    # The covariance is accumulated from chunks of rows, so fit only needs
+    # chunk_size x features of extra memory besides the features^2 scatter
+    # matrix. dtype=np.float32 halves the size of the scatter matrix.
+    # transform also works on chunk_size rows at a time. With low_rank=True it
+    # only uses the components with eigenvalues above the regularization, and
+    # scales the remaining directions by a single factor.
+    # ddof=0 gives the covariance (1/N) X'X of SCWhiteningNormalizer.
+    # transform(X, out=X) whitens X in place.
+    def __init__(self, regularization='auto', retain_variance=0.99, dtype=np.float64,
+                 chunk_size=4096, low_rank=False, ddof=1):
         self.regularization = regularization
         self.S = None
         self.retain_variance = retain_variance
-        self.copy = copy
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.low_rank = low_rank
+        self.ddof = ddof
 
-    def fit(self, X, y=None):
-        X = as_float_array(X, copy=self.copy)
-        self.mean_ = np.mean(X, axis=0)
-        X = X - self.mean_
-        sigma = np.dot(X.T, X) / (X.shape[0] - 1)
-        U, S, V = np.linalg.svd(sigma)
+    # Update the running mean and scatter matrix with a chunk of samples.
+    # The whitening matrix is computed by finalize (or by the next transform).
+    def partial_fit(self, X, y=None):
+        X = np.asarray(X, dtype=self.dtype)
+        n = X.shape[0]
+        if n == 0:
+            return self
+        mean = X.mean(axis=0)
+        n_seen = getattr(self, 'n_samples_seen_', 0)
+        if n_seen == 0:
+            rows = X - mean
+            self.mean_ = mean
+            self.scatter_ = np.dot(rows.T, rows)
+        else:
+            # Pairwise update of Chan et al.: the scatter of the merged set is
+            # the sum of both scatters plus a rank one term on the difference
+            # of means, added here as an extra row of the centered chunk.
+            total = n_seen + n
+            delta = mean - self.mean_
+            rows = np.empty((n + 1, X.shape[1]), dtype=self.dtype)
+            np.subtract(X, mean, out=rows[:n])
+            rows[n] = np.sqrt(n_seen * n / total) * delta
+            self.scatter_ += np.dot(rows.T, rows)
+            self.mean_ += delta * (n / total)
+        self.n_samples_seen_ = n_seen + n
+        self._stale = True
+        return self
+
+    # Compute the whitening matrix from the accumulated covariance
+    def finalize(self):
+        sigma = self.scatter_ / (self.n_samples_seen_ - self.ddof)
+        # The covariance is symmetric, eigh is faster than a general SVD.
+        # Eigenvalues are sorted in decreasing order, as returned by the SVD.
+        S, U = np.linalg.eigh(sigma)
+        del sigma
+        S = np.clip(S[::-1], 0, None)
+        U = U[:, ::-1]
         self.S = S
         if self.regularization == 'auto':
             csum = S / S.sum()
             csum = np.cumsum(csum)
             threshold_loc = (csum < self.retain_variance).sum()
             self.regularization = S[threshold_loc]
-        tmp = np.dot(U, np.diag(1 / np.sqrt(S + self.regularization)))
-        self.components_ = np.dot(tmp, U.T)
+        scales = 1 / np.sqrt(S + self.regularization)
+        self.components_ = np.dot(U * scales, U.T)
+        # The mean is folded into the transform: X W' - mean W'
+        self.bias_ = -np.dot(self.mean_, self.components_.T)
+        # Low rank form: W ~ c I + U_k diag(scales_k - c) U_k', where c is the
+        # scale of the average discarded eigenvalue
+        rank = int((S > self.regularization).sum())
+        discarded = S[rank:].mean() if rank < len(S) else 0.0
+        self.isotropic_scale_ = 1 / np.sqrt(discarded + self.regularization)
+        self.eigenvectors_ = np.ascontiguousarray(U[:, 0:rank])
+        self.scales_ = scales[0:rank] - self.isotropic_scale_
+        self._stale = False
         return self
 
-    def transform(self, X):
-        X_transformed = X - self.mean_
-        X_transformed = np.dot(X_transformed, self.components_.T)
-        return X_transformed
+    def _reset(self):
+        for attr in ['n_samples_seen_', 'mean_', 'scatter_', 'components_', 'bias_',
+                     'eigenvectors_', 'scales_', 'isotropic_scale_']:
+            if hasattr(self, attr):
+                delattr(self, attr)
+
+    # Whiten X in blocks of chunk_size rows. The result is written to out if
+    # given, which can be X itself to transform in place.
+    def transform(self, X, out=None):
+        if getattr(self, '_stale', False):
+            self.finalize()
+        X = np.asarray(X)
+        low_rank = self.low_rank or not hasattr(self, 'components_')
+        dtype = self.mean_.dtype
+        if out is None:
+            out = np.empty(X.shape, dtype=np.result_type(X.dtype, dtype))
+        if low_rank:
+            U = self.eigenvectors_.astype(dtype, copy=False)
+            bias = -self.isotropic_scale_ * self.mean_ - np.dot(np.dot(self.mean_, U) * self.scales_, U.T)
+        else:
+            # The whitening matrix U diag(scales) U' is symmetric, so it is
+            # used as is, without a transposed copy (components_ can be a
+            # memory map shared by several processes)
+            W = self.components_
+            bias = self.bias_
+        buf = np.empty((min(self.chunk_size, X.shape[0]), X.shape[1]), dtype=dtype)
+        for start in range(0, X.shape[0], self.chunk_size):
+            chunk = np.ascontiguousarray(X[start:start + self.chunk_size], dtype=dtype)
+            res = buf[0:chunk.shape[0]]
+            if low_rank:
+                np.dot(np.dot(chunk, U) * self.scales_, U.T, out=res)
+                res += self.isotropic_scale_ * chunk
+            elif W.dtype == dtype:
+                np.dot(chunk, W, out=res)
+            else:
+                res[...] = np.dot(chunk.astype(W.dtype), W)
+            np.add(res, bias, out=out[start:start + self.chunk_size])
+        return out
+
+    # Fitted state saved by save and save_shared. Low rank models only keep
+    # the retained eigenvectors.
+    def _state(self):
+        super()._state()
+        arrays = {'mean_': self.mean_, 'S': self.S, 'regularization': self.regularization,
+                  'retain_variance': self.retain_variance, 'n_samples_seen_': self.n_samples_seen_,
+                  'low_rank': self.low_rank, 'ddof': self.ddof}
+        if self.low_rank:
+            arrays.update(eigenvectors_=self.eigenvectors_, scales_=self.scales_,
+                          isotropic_scale_=self.isotropic_scale_)
+        else:
+            arrays.update(components_=self.components_, bias_=self.bias_)
+        return arrays
+
+    @classmethod
+    def _from_state(cls, vals):
+        # Files saved before the ddof option used the sample covariance
+        model = cls(regularization=float(vals['regularization']),
+                    retain_variance=float(vals['retain_variance']),
+                    dtype=vals['mean_'].dtype.type, low_rank=bool(vals['low_rank']),
+                    ddof=int(vals['ddof']) if 'ddof' in vals else 1)
+        for name in vals:
+            if name.endswith('_') or name == 'S':
+                setattr(model, name, vals[name])
+        model.n_samples_seen_ = int(model.n_samples_seen_)
+        if hasattr(model, 'isotropic_scale_'):
+            model.isotropic_scale_ = float(model.isotropic_scale_)
+        model._stale = False
+        return model
+
+
+# Scaling of all values by the mean and standard deviation of all the
+# values of the controls, as AllControlsNormalizer of notebook 4
+class AllControlsNormalizer(StreamingNormalizer):
+
+    def __init__(self, dtype=np.float32, chunk_size=65536, ddof=0):
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.ddof = ddof
+
+    # Running count, mean and sum of squared deviations of all values,
+    # merged across chunks as in ZCA.partial_fit
+    def partial_fit(self, X, y=None):
+        X = np.asarray(X, dtype=np.float64)
+        n = X.size
+        if n == 0:
+            return self
+        mean = X.mean()
+        m2 = np.square(X - mean).sum()
+        n_seen = getattr(self, 'n_values_seen_', 0)
+        if n_seen == 0:
+            self.mean_, self.m2_ = mean, m2
+        else:
+            total = n_seen + n
+            delta = mean - self.mean_
+            self.m2_ += m2 + delta**2 * n_seen * n / total
+            self.mean_ += delta * n / total
+        self.n_values_seen_ = n_seen + n
+        self._stale = True
+        return self
+
+    def finalize(self):
+        self.std_ = float(np.sqrt(self.m2_ / (self.n_values_seen_ - self.ddof)))
+        self.mean_ = float(self.mean_)
+        self._stale = False
+        return self
+
+    def _reset(self):
+        for attr in ['n_values_seen_', 'mean_', 'm2_', 'std_']:
+            if hasattr(self, attr):
+                delattr(self, attr)
+
+    def transform(self, X, out=None):
+        if getattr(self, '_stale', False):
+            self.finalize()
+        X = np.asarray(X)
+        if out is None:
+            out = np.empty(X.shape, dtype=np.result_type(X.dtype, self.dtype))
+        for start in range(0, X.shape[0], self.chunk_size):
+            block = out[start:start + self.chunk_size]
+            np.subtract(X[start:start + self.chunk_size], self.mean_, out=block, casting='unsafe')
+            block /= self.std_
+        return out
+
+    def _state(self):
+        super()._state()
+        return {'mean_': self.mean_, 'std_': self.std_, 'n_values_seen_': self.n_values_seen_,
+                'ddof': self.ddof}
+
+    @classmethod
+    def _from_state(cls, vals):
+        model = cls(ddof=int(vals['ddof']))
+        model.mean_ = float(vals['mean_'])
+        model.std_ = float(vals['std_'])
+        model.n_values_seen_ = int(vals['n_values_seen_'])
+        model._stale = False
+        return model